@@ -1,11 +1,18 @@
 from fastapi import FastAPI, Request, HTTPException, Response, Query
-from fastapi.responses import HTMLResponse
-from helpers import HMACDecoder, Endpoints, FileCleaner, Logger
+from fastapi.responses import HTMLResponse, PlainTextResponse
+from helpers import HMACDecoder, Endpoints, FileCleaner, ManifestDecoder, Logger
 from helpers.RequestManager import RequestManager
-from helpers.TypeHelpers import AssetOS, DiffVersion, Swagger
+from helpers.DecodeEngine import DecodeEngine
+from helpers.ImageCache import ImageCache
+from helpers.BundleCache import BundleCache
+from helpers.VersionResolver import VersionResolver
+from helpers.Prewarmer import Prewarmer
+from helpers.LoopMonitor import LoopMonitor
+from helpers.Metrics import Metrics
+from helpers.TypeHelpers import AssetOS, DiffVersion, DependencyMode, BatchFormat, ImageFormat, ObjectType, Swagger
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from typing import Dict, List, Union, Annotated
+from typing import Dict, List, Optional, Union, Annotated
 import aiofiles
 import os
 
@@ -13,8 +20,20 @@ load_dotenv()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    LoopMonitor.start()
+    DecodeEngine.start()
+    VersionResolver.start()
+    BundleCache.start()
+    ImageCache.start()
+    Prewarmer.start()
     yield
+    await Prewarmer.stop()
+    await ImageCache.stop()
+    await BundleCache.stop()
+    await VersionResolver.stop()
     await RequestManager.httpClient.aclose()
+    DecodeEngine.shutdown()
+    await LoopMonitor.stop()
 
 app = FastAPI(lifespan=lifespan, title='SWGoH AssetAPI', description='Download 2D assets from SWGoH', docs_url='/swagger')
 HMAC_helper = HMACDecoder.HMACHelper()
@@ -26,6 +45,9 @@ COMLINK_URL = os.getenv('COMLINK_URL', 'False')
 
 if COMLINK_URL == 'False':
     logger.info('No comlink was specified, version=0 is not valid')
+VersionResolver.configure(COMLINK_URL, COMLINK_SECRET, COMLINK_PUBLIC)
+if Prewarmer.enabled:
+    VersionResolver.onVersionChange(Prewarmer.versionChanged)
 
 @app.get('/')
 @app.get('/docs')
@@ -36,43 +58,55 @@ async def docsEndpoint() -> HTMLResponse:
 @app.get("/cleanup")
 async def cleanupEndpoint() -> Dict[str, str]:
     await FileCleaner.cleanup(os.path.abspath('tmp'))
+    ImageCache.clear()
+    BundleCache.clear()
+    ManifestDecoder.ManifestCache.clear()
     return {"status": "done"}
 
+@app.get("/stats")
+async def statsEndpoint() -> Dict[str, Dict[str, Union[int, float, Dict[str, int]]]]:
+    return {"downloads": RequestManager.scheduler.getStats()}
+
+@app.get("/metrics")
+async def metricsEndpoint() -> PlainTextResponse:
+    return PlainTextResponse(Metrics.render(), media_type='text/plain; version=0.0.4')
+
 @app.get('/Asset/single')
 async def assetSingleAssetEndpoint(request: Request, 
                                    version: Annotated[int, Query(description=Swagger.versionDesc)], 
                                    assetName: Annotated[str, Query(description=Swagger.assetNameDesc)], 
                                    forceReDownload: Annotated[bool, Query(description=Swagger.forceReDownloadDesc)]=False, 
-                                   assetOS: Annotated[AssetOS, Query(description=Swagger.assetOSDesc)]=AssetOS.WINDOWS
+                                   assetOS: Annotated[AssetOS, Query(description=Swagger.assetOSDesc)]=AssetOS.WINDOWS, 
+                                   imageFormat: Annotated[ImageFormat, Query(description=Swagger.imageFormatDesc)]=ImageFormat.PNG, 
+                                   quality: Annotated[Optional[int], Query(description=Swagger.qualityDesc)]=None, 
+                                   objectName: Annotated[Optional[str], Query(description=Swagger.objectNameDesc)]=None, 
+                                   objectType: Annotated[ObjectType, Query(description=Swagger.objectTypeDesc)]=ObjectType.ALL
                                    ) -> Response:
     if not HMAC_helper.verifyHMACRequest(request.headers, request.url.path, b'GET'):
         raise HTTPException(status_code=401, detail="Invalid or missing signature and or timestamp")
     
-    if version == 0 and COMLINK_URL != 'False':
-        versionFinal = await RequestManager.getAssetVersion(COMLINK_URL, secret_key=COMLINK_SECRET, access_key=COMLINK_PUBLIC)
-        logger.info(f'Got assetVersion of {versionFinal} from comlink')
-    else:
-        versionFinal = version
+    versionFinal = await VersionResolver.resolve(version)
 
-    return await Endpoints.assetSingle(versionFinal, assetName, forceReDownload, assetOS)
+    return await Endpoints.assetSingle(versionFinal, assetName, forceReDownload, assetOS, imageFormat, quality, objectName, objectType)
 
-@app.get('/Asset/many')
+@app.get('/Asset/many', response_model=List[Dict[str, Union[str, List[Dict[str, Union[str, bool, int]]]]]])
 async def assetManyEndpoint(request: Request, 
                             version: Annotated[int, Query(description=Swagger.versionDesc)], 
                             assetNames: Annotated[str, Query(description=Swagger.assetNamesDesc)], 
                             forceReDownload: Annotated[bool, Query(description=Swagger.forceReDownloadDesc)]=False, 
-                            assetOS: Annotated[AssetOS, Query(description=Swagger.assetOSDesc)]=AssetOS.WINDOWS
-                            ) -> List[Dict[str, Union[str, List[Dict[str, Union[str, bool]]]]]]:
+                            assetOS: Annotated[AssetOS, Query(description=Swagger.assetOSDesc)]=AssetOS.WINDOWS, 
+                            batchFormat: Annotated[BatchFormat, Query(description=Swagger.batchFormatDesc)]=BatchFormat.JSON, 
+                            imageFormat: Annotated[ImageFormat, Query(description=Swagger.imageFormatDesc)]=ImageFormat.PNG, 
+                            quality: Annotated[Optional[int], Query(description=Swagger.qualityDesc)]=None, 
+                            objectNames: Annotated[Optional[str], Query(description=Swagger.objectNamesDesc)]=None, 
+                            objectType: Annotated[ObjectType, Query(description=Swagger.objectTypeDesc)]=ObjectType.ALL
+                            ) -> Union[List[Dict[str, Union[str, List[Dict[str, Union[str, bool, int]]]]]], Response]:
     if not HMAC_helper.verifyHMACRequest(request.headers, request.url.path, b'GET'):
         raise HTTPException(status_code=401, detail="Invalid or missing signature and or timestamp")
     
-    if version == 0 and COMLINK_URL != 'False':
-        versionFinal = await RequestManager.getAssetVersion(COMLINK_URL, secret_key=COMLINK_SECRET, access_key=COMLINK_PUBLIC)
-        logger.info(f'Got assetVersion of {versionFinal} from comlink')
-    else:
-        versionFinal = version
+    versionFinal = await VersionResolver.resolve(version)
 
-    return await Endpoints.assetMany(versionFinal, assetNames, forceReDownload, assetOS)
+    return await Endpoints.assetMany(versionFinal, assetNames, forceReDownload, assetOS, batchFormat, imageFormat, quality, objectNames, objectType)
 
 @app.get('/Asset/list')
 async def getManifestEndpoint(request: Request, 
@@ -83,53 +117,50 @@ async def getManifestEndpoint(request: Request,
     if not HMAC_helper.verifyHMACRequest(request.headers, request.url.path, b'GET'):
         raise HTTPException(status_code=401, detail="Invalid or missing signature and or timestamp")
     
-    if version == 0 and COMLINK_URL != 'False':
-        versionFinal = await RequestManager.getAssetVersion(COMLINK_URL, secret_key=COMLINK_SECRET, access_key=COMLINK_PUBLIC)
-        logger.info(f'Got assetVersion of {versionFinal} from comlink')
-    else:
-        versionFinal = version
+    versionFinal = await VersionResolver.resolve(version)
 
     return await Endpoints.assetList(versionFinal, forceReDownload, assetOS)
 
 @app.get('/Asset/listDiff')
 async def listDiffEndpoint(request: Request, 
+                           response: Response, 
                            version: Annotated[int, Query(description=Swagger.versionDesc)], 
                            diffVersion: Annotated[int, Query(description=Swagger.diffVersionDesc)], 
                            forceReDownload: Annotated[bool, Query(description=Swagger.forceReDownloadDesc)]=False, 
                            diffType: Annotated[DiffVersion, Query(description=Swagger.diffTypeDesc)]=DiffVersion.ALL, 
                            prefix: Annotated[str, Query(description=Swagger.prefixDesc)]='None', 
-                           assetOS: Annotated[AssetOS, Query(description=Swagger.assetOSDesc)]=AssetOS.WINDOWS
+                           assetOS: Annotated[AssetOS, Query(description=Swagger.assetOSDesc)]=AssetOS.WINDOWS, 
+                           dependencyMode: Annotated[DependencyMode, Query(description=Swagger.dependencyModeDesc)]=DependencyMode.NONE, 
+                           skipUnchanged: Annotated[bool, Query(description=Swagger.skipUnchangedDesc)]=False
                            ) -> List[str]:
     if not HMAC_helper.verifyHMACRequest(request.headers, request.url.path, b'GET'):
         raise HTTPException(status_code=401, detail="Invalid or missing signature and or timestamp")
     
-    if version == 0 and COMLINK_URL != 'False':
-        versionFinal = await RequestManager.getAssetVersion(COMLINK_URL, secret_key=COMLINK_SECRET, access_key=COMLINK_PUBLIC)
-        logger.info(f'Got assetVersion of {versionFinal} from comlink')
-    else:
-        versionFinal = version
+    versionFinal = await VersionResolver.resolve(version)
 
-    return await Endpoints.assetListDiff(versionFinal, diffVersion, forceReDownload, diffType, prefix, assetOS)
+    return await Endpoints.assetListDiff(versionFinal, diffVersion, forceReDownload, diffType, prefix, assetOS, dependencyMode, skipUnchanged, response)
 
-@app.get('/Asset/getDiff')
+@app.get('/Asset/getDiff', response_model=List[Dict[str, Union[str, List[Dict[str, Union[str, bool, int]]]]]])
 async def getDiffEndpoint(request: Request, 
+                          response: Response, 
                           version: Annotated[int, Query(description=Swagger.versionDesc)], 
                           diffVersion: Annotated[int, Query(description=Swagger.diffVersionDesc)], 
                           forceReDownload: Annotated[bool, Query(description=Swagger.forceReDownloadDesc)]=False, 
                           diffType: Annotated[DiffVersion, Query(description=Swagger.diffTypeDesc)]=DiffVersion.ALL, 
                           prefix: Annotated[str, Query(description=Swagger.prefixDesc)]='None', 
-                          assetOS: Annotated[AssetOS, Query(description=Swagger.assetOSDesc)]=AssetOS.WINDOWS
-                          ) -> List[Dict[str, Union[str, List[Dict[str, Union[str, bool]]]]]]:
+                          assetOS: Annotated[AssetOS, Query(description=Swagger.assetOSDesc)]=AssetOS.WINDOWS, 
+                          dependencyMode: Annotated[DependencyMode, Query(description=Swagger.dependencyModeDesc)]=DependencyMode.NONE, 
+                          skipUnchanged: Annotated[bool, Query(description=Swagger.skipUnchangedDesc)]=False, 
+                          batchFormat: Annotated[BatchFormat, Query(description=Swagger.batchFormatDesc)]=BatchFormat.JSON, 
+                          imageFormat: Annotated[ImageFormat, Query(description=Swagger.imageFormatDesc)]=ImageFormat.PNG, 
+                          quality: Annotated[Optional[int], Query(description=Swagger.qualityDesc)]=None
+                          ) -> Union[List[Dict[str, Union[str, List[Dict[str, Union[str, bool, int]]]]]], Response]:
     if not HMAC_helper.verifyHMACRequest(request.headers, request.url.path, b'GET'):
         raise HTTPException(status_code=401, detail="Invalid or missing signature and or timestamp")
     
-    if version == 0 and COMLINK_URL != 'False':
-        versionFinal = await RequestManager.getAssetVersion(COMLINK_URL, secret_key=COMLINK_SECRET, access_key=COMLINK_PUBLIC)
-        logger.info(f'Got assetVersion of {versionFinal} from comlink')
-    else:
-        versionFinal = version
+    versionFinal = await VersionResolver.resolve(version)
 
-    return await Endpoints.assetGetDiff(versionFinal, diffVersion, forceReDownload, diffType, prefix, assetOS)
+    return await Endpoints.assetGetDiff(versionFinal, diffVersion, forceReDownload, diffType, prefix, assetOS, dependencyMode, skipUnchanged, response, batchFormat, imageFormat, quality)
 
 @app.get('/Asset/bundle')
 async def assetBundleEndpoint(request: Request,
@@ -141,16 +172,15 @@ async def assetBundleEndpoint(request: Request,
     if not HMAC_helper.verifyHMACRequest(request.headers, request.url.path, b'GET'):
         raise HTTPException(status_code=401, detail="Invalid or missing signature and or timestamp")
     
-    if version == 0 and COMLINK_URL != 'False':
-        versionFinal = await RequestManager.getAssetVersion(COMLINK_URL, secret_key=COMLINK_SECRET, access_key=COMLINK_PUBLIC)
-        logger.info(f'Got assetVersion of {versionFinal} from comlink')
-    else:
-        versionFinal = version
+    versionFinal = await VersionResolver.resolve(version)
 
-    return await Endpoints.getAssetBundle(bundleName, versionFinal, forceReDownload, assetOS)
+    return await Endpoints.getAssetBundle(bundleName, versionFinal, forceReDownload, assetOS, request.headers.get('if-none-match'), request.headers.get('range'), request.headers.get('if-range'), request.headers.get('if-modified-since'))
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host=os.getenv("HOST", "0.0.0.0"), port=int(os.getenv("PORT", "3300")), log_config=None)
-else:
+    workers = int(os.getenv("WORKERS", "1"))
+    # More than one worker needs an import string, every worker process imports the app on its own
+    uvicorn.run("assetapi:app" if workers > 1 else app, host=os.getenv("HOST", "0.0.0.0"), port=int(os.getenv("PORT", "3300")), workers=workers, log_config=None)
+elif __name__ != '__mp_main__' and int(os.getenv("WORKERS", "1")) <= 1:
+    # Decode workers re-import this module as __mp_main__ when they spawn
     logger.warning('App is not run as __main__, not starting the uvicorn server. If you are starting with uvicorn cli, this is fine.')
\ No newline at end of file
@@ -0,0 +1,87 @@
+# Compares ManifestDiff.compareManifest against the list scanning version it replaced, on synthetic manifests.
+# Run from the repository root with: python benchmarks/bench_diff.py --records 20000
+from typing import Any, Dict, List
+import argparse
+import random
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helpers import ManifestDiff
+from helpers.TypeHelpers import DiffVersion
+
+PREFIXES = ['charui', 'ability', 'audio', 'shared', 'icon', 'tex', 'unit', 'env']
+
+def makeManifests(records: int, changed: float, added: float, removed: float, seed: int):
+    rnd = random.Random(seed)
+    oldManifest: List[Dict[str, Any]] = []
+    newManifest: List[Dict[str, Any]] = []
+    for i in range(records):
+        prefix = PREFIXES[i % len(PREFIXES)]
+        record = {"name": f'{prefix}_asset{i}', "version": 1, "prefix": prefix, "size": 1000 + i, "crc": rnd.getrandbits(32)}
+        if rnd.random() >= added:
+            oldManifest.append(record)
+        if rnd.random() >= removed:
+            if rnd.random() < changed:
+                record = dict(record, version=2, crc=rnd.getrandbits(32))
+            newManifest.append(record)
+
+    return newManifest, oldManifest
+
+# The implementation from before the hash based engine, kept here so the speedup can be measured
+def legacyCompareManifest(newManifest: List[Dict[str, Any]], oldManifest: List[Dict[str, Any]]) -> List[str]:
+    oldNames = [record['name'] for record in oldManifest]
+    oldVersions = [{"name": record['name'], "version": record['version']} for record in oldManifest]
+
+    newAssets = [record['name'] for record in newManifest if record['name'] not in oldNames]
+    changedAssets = []
+    for record in newManifest:
+        if record['name'] in oldNames:
+            for old in oldVersions:
+                if old['name'] == record['name']:
+                    if old['version'] != record['version']:
+                        changedAssets.append(record['name'])
+                    break
+
+    return newAssets + changedAssets
+
+def timeIt(func, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the manifest diff engine')
+    parser.add_argument('--records', type=int, default=10000, help='Records per manifest')
+    parser.add_argument('--changed', type=float, default=0.05, help='Fraction of records with a new version')
+    parser.add_argument('--added', type=float, default=0.02, help='Fraction of records only in the new manifest')
+    parser.add_argument('--removed', type=float, default=0.01, help='Fraction of records only in the old manifest')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per implementation, the best one is reported')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--skip-legacy', action='store_true', help="Don't run the old implementation, it is very slow on big manifests")
+    args = parser.parse_args()
+
+    newManifest, oldManifest = makeManifests(args.records, args.changed, args.added, args.removed, args.seed)
+    print(f'{len(newManifest)} new records, {len(oldManifest)} old records')
+
+    result = ManifestDiff.compareManifest(newManifest, oldManifest, DiffVersion.ALL)
+    current = timeIt(lambda: ManifestDiff.compareManifest(newManifest, oldManifest, DiffVersion.ALL), args.repeat)
+    print(f'compareManifest: {current * 1000:.2f} ms, {len(result)} assets')
+
+    if not args.skip_legacy:
+        legacyResult = legacyCompareManifest(newManifest, oldManifest)
+        if legacyResult != result:
+            raise SystemExit('The legacy and current implementations returned different assets')
+
+        legacy = timeIt(lambda: legacyCompareManifest(newManifest, oldManifest), args.repeat)
+        print(f'legacy:          {legacy * 1000:.2f} ms, {len(legacyResult)} assets')
+        print(f'speedup:         {legacy / current:.1f}x')
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -0,0 +1,389 @@
+# Offline benchmarks for the manifest, diff, decode and endpoint hot paths. The CDN and comlink are replaced by the
+# stand-in server from stub_server.py, bundles and manifests are generated by synthetic.py.
+# Run from the repository root with: python benchmarks/bench_suite.py --output results.json
+# Compare against an earlier run with: python benchmarks/bench_suite.py --baseline before.json --output after.json
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+import multiprocessing
+import subprocess
+import threading
+import tempfile
+import argparse
+import platform
+import asyncio
+import logging
+import shutil
+import json
+import time
+import sys
+import os
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+import synthetic
+from stub_server import stub_cdn
+
+STAGES = ['manifest_decode', 'manifest_diff', 'decode_bundle', 'img_to_b64', 'decode_pool', 'endpoints']
+
+def getRss(pid: str='self') -> int:
+    # Linux only, everywhere else the peak from getrusage is reported instead
+    try:
+        with open(f'/proc/{pid}/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def getPeakRusage() -> int:
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB everywhere else
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class rss_sampler:
+    def __init__(self, interval: float=0.01):
+        self.interval = interval
+        self.peak = 0
+        self.peakChildren = 0
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def sample(self):
+        self.peak = max(self.peak, getRss())
+        # The decode pool workers, they hold the bundles and images while decoding
+        children = sum(getRss(str(child.pid)) for child in multiprocessing.active_children())
+        self.peakChildren = max(self.peakChildren, children)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.sample()
+        if self.peak == 0:
+            self.peak = getPeakRusage()
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+def summarize(latencies: List[float], elapsed: float, payloadBytes: int, sampler: rss_sampler, errors: int=0, extra: Optional[Dict[str, Any]]=None) -> Dict[str, Any]:
+    result = {
+        "calls": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 6),
+        "throughput": round(len(latencies) / elapsed, 3) if elapsed > 0 else 0.0,
+        "bytesPerSecond": round(payloadBytes / elapsed, 1) if elapsed > 0 else 0.0,
+        "latencyMs": {
+            "mean": round(sum(latencies) / len(latencies) * 1000, 4) if latencies else 0.0,
+            "p50": round(percentile(latencies, 0.5) * 1000, 4),
+            "p90": round(percentile(latencies, 0.9) * 1000, 4),
+            "p99": round(percentile(latencies, 0.99) * 1000, 4),
+            "max": round(max(latencies) * 1000, 4) if latencies else 0.0
+        },
+        "peakRssMB": round(sampler.peak / 1024 / 1024, 1),
+        "peakWorkerRssMB": round(sampler.peakChildren / 1024 / 1024, 1)
+    }
+    if extra:
+        result.update(extra)
+
+    return result
+
+def runSync(func: Callable[[int], int], calls: int) -> Tuple[List[float], float, int]:
+    latencies: List[float] = []
+    payloadBytes = 0
+    started = time.perf_counter()
+    for i in range(calls):
+        callStarted = time.perf_counter()
+        payloadBytes += func(i)
+        latencies.append(time.perf_counter() - callStarted)
+
+    return latencies, time.perf_counter() - started, payloadBytes
+
+async def runAsync(func: Callable[[int], Awaitable[int]], calls: int, concurrency: int) -> Tuple[List[float], float, int, int]:
+    latencies: List[float] = []
+    payloadBytes = 0
+    errors = 0
+    slots = asyncio.Semaphore(max(1, concurrency))
+
+    async def call(i: int):
+        nonlocal payloadBytes, errors
+        async with slots:
+            callStarted = time.perf_counter()
+            try:
+                payloadBytes += await func(i)
+            except Exception as e:
+                errors += 1
+                logging.getLogger('bench').warning(f'Call {i} failed: {e}')
+            latencies.append(time.perf_counter() - callStarted)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[call(i) for i in range(calls)])
+
+    return latencies, time.perf_counter() - started, payloadBytes, errors
+
+def benchManifestDecode(args: argparse.Namespace, cdn: stub_cdn) -> Dict[str, Any]:
+    from helpers import ManifestDecoder
+    raw = cdn.getManifest(1)
+    with rss_sampler() as sampler:
+        latencies, elapsed, payloadBytes = runSync(lambda i: len(ManifestDecoder.decodeManifest(raw)) and len(raw), args.repeat)
+
+    return {"manifest_decode": summarize(latencies, elapsed, payloadBytes, sampler, extra={"records": args.records})}
+
+def benchManifestDiff(args: argparse.Namespace, cdn: stub_cdn) -> Dict[str, Any]:
+    from helpers import ManifestDecoder, ManifestDiff
+    from helpers.TypeHelpers import DiffVersion
+    oldManifest = ManifestDecoder.decodeManifest(cdn.getManifest(1))
+    newManifest = ManifestDecoder.decodeManifest(cdn.getManifest(2))
+    changed = len(ManifestDiff.compareManifest(newManifest, oldManifest, DiffVersion.ALL))
+    with rss_sampler() as sampler:
+        latencies, elapsed, _ = runSync(lambda i: len(ManifestDiff.compareManifest(newManifest, oldManifest, DiffVersion.ALL)), args.repeat)
+
+    return {"manifest_diff": summarize(latencies, elapsed, 0, sampler, extra={"records": args.records, "changed": changed})}
+
+def writeBundles(args: argparse.Namespace, cdn: stub_cdn) -> List[Tuple[str, str]]:
+    os.makedirs('bench_bundles', exist_ok=True)
+    bundles: List[Tuple[str, str]] = []
+    for i in range(args.bundles):
+        name = synthetic.getAssetName(i)
+        path = os.path.abspath(os.path.join('bench_bundles', f'{name}.bundle'))
+        with open(path, 'wb') as file:
+            file.write(cdn.getBundle(name))
+        bundles.append((name, path))
+
+    return bundles
+
+def benchDecodeBundle(args: argparse.Namespace, bundles: List[Tuple[str, str]]) -> Dict[str, Any]:
+    # UnityPy load, texture decode and PNG encode in this process, without the pool or any cache in the way
+    from helpers import DecodeWorker
+    DecodeWorker.preload()
+    stages: Dict[str, List[float]] = {"load": [], "decode": [], "encode": []}
+
+    def decode(i: int) -> int:
+        _, path = bundles[i % len(bundles)]
+        images, timings = DecodeWorker.decodeAll(path)
+        for stage, values in timings.items():
+            stages[stage] += values
+        return os.path.getsize(path)
+
+    with rss_sampler() as sampler:
+        latencies, elapsed, payloadBytes = runSync(decode, args.repeat)
+    breakdown = {f'{stage}MeanMs': round(sum(values) / len(values) * 1000, 4) if values else 0.0 for stage, values in stages.items()}
+
+    return {"decode_bundle": summarize(latencies, elapsed, payloadBytes, sampler, extra=breakdown)}
+
+def benchImgToB64(args: argparse.Namespace, bundles: List[Tuple[str, str]]) -> Dict[str, Any]:
+    from helpers import DecodeWorker, Texture2DDecoder
+    images = [image["img"] for image in DecodeWorker.decodeAll(bundles[0][1])[0] if image["valid"]]
+    with rss_sampler() as sampler:
+        latencies, elapsed, payloadBytes = runSync(lambda i: len(Texture2DDecoder.imgToB64(images[i % len(images)])), args.repeat * len(images))
+
+    return {"img_to_b64": summarize(latencies, elapsed, payloadBytes, sampler)}
+
+async def benchDecodePool(args: argparse.Namespace, bundles: List[Tuple[str, str]]) -> Dict[str, Any]:
+    # decodeManyAssets through the worker pool, refresh skips the image cache so every call decodes
+    from helpers import Texture2DDecoder
+    from helpers.DecodeEngine import DecodeEngine
+    await DecodeEngine.warm()
+
+    async def decode(i: int) -> int:
+        name, path = bundles[i % len(bundles)]
+        images = await Texture2DDecoder.decodeManyAssets(path, name, 'bench', refresh=True)
+        return sum(len(image["img"]) for image in images)
+
+    with rss_sampler() as sampler:
+        latencies, elapsed, payloadBytes, errors = await runAsync(decode, args.repeat, args.concurrency)
+
+    return {"decode_pool": summarize(latencies, elapsed, payloadBytes, sampler, errors, {"workers": DecodeEngine.workers})}
+
+async def benchEndpoints(args: argparse.Namespace, cdn: stub_cdn) -> Dict[str, Any]:
+    import httpx
+    import assetapi
+    from helpers.DecodeEngine import DecodeEngine
+    logging.getLogger().setLevel(logging.WARNING)
+
+    names = [synthetic.getAssetName(i) for i in range(args.bundles)]
+    batches = [','.join(names[i:i + args.batch]) for i in range(0, len(names), args.batch)]
+    results: Dict[str, Any] = {}
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=assetapi.app), base_url='http://bench', timeout=None)
+
+    async def get(path: str, params: Dict[str, Any]) -> int:
+        response = await client.get(path, params=params)
+        if response.status_code != 200:
+            raise RuntimeError(f'{path} returned {response.status_code}: {response.text[:200]}')
+        return len(response.content)
+
+    # (stage, endpoint, parameters for call i, calls, concurrency)
+    endpoints: List[Tuple[str, str, Callable[[int], Dict[str, Any]], int, int]] = [
+        ('single_cold', '/Asset/single', lambda i: {"version": 2, "assetName": names[i % len(names)], "forceReDownload": True}, args.repeat, args.concurrency),
+        ('single_warm', '/Asset/single', lambda i: {"version": 2, "assetName": names[i % len(names)]}, args.repeat, args.concurrency),
+        ('version_resolve', '/Asset/single', lambda i: {"version": 0, "assetName": names[i % len(names)]}, args.repeat, args.concurrency),
+        ('bundle', '/Asset/bundle', lambda i: {"version": 2, "bundleName": names[i % len(names)]}, args.repeat, args.concurrency),
+        ('many_cold', '/Asset/many', lambda i: {"version": 2, "assetNames": batches[i % len(batches)], "forceReDownload": True}, max(1, args.repeat // args.batch), 1),
+        ('many_warm', '/Asset/many', lambda i: {"version": 2, "assetNames": batches[i % len(batches)]}, max(1, args.repeat // args.batch), 1),
+        ('list_diff', '/Asset/listDiff', lambda i: {"version": 2, "diffVersion": 1}, args.repeat, args.concurrency),
+        ('get_diff_cold', '/Asset/getDiff', lambda i: {"version": 2, "diffVersion": 1, "prefix": args.diffPrefix, "forceReDownload": True}, 1, 1),
+        ('get_diff_warm', '/Asset/getDiff', lambda i: {"version": 2, "diffVersion": 1, "prefix": args.diffPrefix}, 3, 1)
+    ]
+
+    async with assetapi.lifespan(assetapi.app):
+        await DecodeEngine.warm()
+        for stage, path, params, calls, concurrency in endpoints:
+            requestsBefore = cdn.requests
+            with rss_sampler() as sampler:
+                latencies, elapsed, payloadBytes, errors = await runAsync(lambda i: get(path, params(i)), calls, concurrency)
+            results[f'endpoint_{stage}'] = summarize(latencies, elapsed, payloadBytes, sampler, errors, {"cdnRequests": cdn.requests - requestsBefore})
+            log(stage, results[f'endpoint_{stage}'])
+    await client.aclose()
+
+    return results
+
+def log(stage: str, result: Dict[str, Any]):
+    latency = result["latencyMs"]
+    print(f'{stage:<28} {result["calls"]:>6} calls {result["throughput"]:>10.1f}/s  '
+          f'p50 {latency["p50"]:>9.2f}ms  p99 {latency["p99"]:>9.2f}ms  rss {result["peakRssMB"]:>7.1f}MB'
+          + (f'  errors {result["errors"]}' if result["errors"] else ''), file=sys.stderr)
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any]):
+    print(f'\n{"stage":<28} {"p50 before":>12} {"p50 after":>12} {"change":>8}   {"throughput change":>18}', file=sys.stderr)
+    for stage, result in results["stages"].items():
+        before = baseline.get("stages", {}).get(stage)
+        if before is None:
+            continue
+        oldP50, newP50 = before["latencyMs"]["p50"], result["latencyMs"]["p50"]
+        latencyChange = f'{(newP50 / oldP50 - 1) * 100:+.1f}%' if oldP50 else 'n/a'
+        throughputChange = f'{(result["throughput"] / before["throughput"] - 1) * 100:+.1f}%' if before["throughput"] else 'n/a'
+        print(f'{stage:<28} {oldP50:>10.2f}ms {newP50:>10.2f}ms {latencyChange:>8}   {throughputChange:>18}', file=sys.stderr)
+
+def getCommit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def runStages(args: argparse.Namespace, cdn: stub_cdn, stages: List[str]) -> Dict[str, Any]:
+    results: Dict[str, Any] = {}
+
+    def add(stageResults: Dict[str, Any]):
+        for stage, result in stageResults.items():
+            results[stage] = result
+            log(stage, result)
+
+    if 'manifest_decode' in stages:
+        add(benchManifestDecode(args, cdn))
+    if 'manifest_diff' in stages:
+        add(benchManifestDiff(args, cdn))
+
+    bundles = writeBundles(args, cdn)
+    if 'decode_bundle' in stages:
+        add(benchDecodeBundle(args, bundles))
+    if 'img_to_b64' in stages:
+        add(benchImgToB64(args, bundles))
+    if 'decode_pool' in stages:
+        add(await benchDecodePool(args, bundles))
+    if 'endpoints' in stages:
+        # Logged as they finish, they take the longest
+        results.update(await benchEndpoints(args, cdn))
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the AssetAPI hot paths offline')
+    parser.add_argument('--stages', default=','.join(STAGES), help=f'Comma separated stages to run, out of {",".join(STAGES)}')
+    parser.add_argument('--records', type=int, default=20000, help='Records per synthetic manifest')
+    parser.add_argument('--changed', type=float, default=0.05, help='Fraction of records changed between the two manifest versions')
+    parser.add_argument('--bundles', type=int, default=16, help='Distinct bundles the decode and endpoint stages cycle through')
+    parser.add_argument('--textures', type=int, default=4, help='Textures per bundle')
+    parser.add_argument('--size', type=int, default=512, help='Width and height of every texture')
+    parser.add_argument('--sprites', type=int, default=0, help='Sprites cut from the first texture of every bundle')
+    parser.add_argument('--repeat', type=int, default=20, help='Calls per stage')
+    parser.add_argument('--concurrency', type=int, default=4, help='Calls in flight at once for the async stages')
+    parser.add_argument('--batch', type=int, default=8, help='Assets per /Asset/many request')
+    parser.add_argument('--diff-prefix', dest='diffPrefix', default='charui', help='Prefix /Asset/getDiff is limited to, None for every changed asset')
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1), help='DECODE_WORKERS for the pool')
+    parser.add_argument('--delay', type=float, default=0.0, help='Milliseconds the stand-in CDN waits before every response')
+    parser.add_argument('--variants', type=int, default=8, help='Distinct bundles per record version the stand-in CDN serves')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='-', help='File to write the JSON results to, - for stdout')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--keep', action='store_true', help="Keep the working directory with the caches and bundles")
+    args = parser.parse_args()
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        parser.error(f'Unknown stages: {", ".join(unknown)}')
+
+    cdn = stub_cdn(args.records, args.changed, args.textures, args.size, args.sprites, 2, args.delay / 1000, args.seed, args.variants)
+    url = cdn.start()
+
+    # The API keeps its caches in tmp/ under the working directory, so every run starts cold and nothing lands in the repo
+    workdir = tempfile.mkdtemp(prefix='assetapi-bench-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    os.environ.update({
+        "CDN_URL": url,
+        "COMLINK_URL": url,
+        "DECODE_WORKERS": str(args.workers),
+        "LOG_FILE": "False",
+        "WARM_START": "False",
+        "PREWARM": "False",
+        # The stand-in manifests list the real crc and size of every bundle, so downloads are checked like in production
+        "VERIFY_CRC": "True"
+    })
+    # Set to the 'False' default instead of removed, load_dotenv only fills in variables that aren't set
+    for name in ['ACCESS_KEY', 'SECRET_KEY', 'COMLINK_PUBLIC', 'COMLINK_SECRET']:
+        os.environ[name] = 'False'
+
+    print(f'Working in {workdir}, stand-in CDN and comlink on {url}', file=sys.stderr)
+    started = time.perf_counter()
+    try:
+        results = {
+            "meta": {
+                "commit": getCommit(),
+                "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "args": vars(args)
+            },
+            "stages": asyncio.run(runStages(args, cdn, stages))
+        }
+        results["meta"]["seconds"] = round(time.perf_counter() - started, 3)
+    finally:
+        cdn.stop()
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            compare(results, json.load(file))
+
+    output = json.dumps(results, indent=2)
+    if args.output == '-':
+        print(output)
+    else:
+        with open(args.output, 'w') as file:
+            file.write(output)
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
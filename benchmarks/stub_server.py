@@ -0,0 +1,162 @@
+# A local stand-in for the CDN and comlink. Point CDN_URL and COMLINK_URL at it and the API runs fully offline.
+# It can also be run on its own: python benchmarks/stub_server.py --port 3400
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional, Tuple
+import argparse
+import threading
+import json
+import zlib
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic
+
+class stub_cdn:
+    def __init__(self,
+                 records: int=2000,
+                 changed: float=0.05,
+                 textures: int=4,
+                 size: int=256,
+                 sprites: int=0,
+                 latestVersion: int=2,
+                 delay: float=0.0,
+                 seed: int=1,
+                 variants: int=8):
+        self.records = records
+        self.changed = changed
+        self.textures = textures
+        self.size = size
+        self.sprites = sprites
+        self.latestVersion = latestVersion
+        # Seconds added to every response, to stand in for the round trip to the real CDN
+        self.delay = delay
+        self.seed = seed
+        # Distinct bundles per record version, records share them round robin so the manifest doesn't need one per record
+        self.variants = max(1, variants)
+        self.manifests: Dict[int, bytes] = {}
+        # assetVersion -> record index -> record version, what each manifest promised
+        self.recordVersions: Dict[int, Dict[int, int]] = {}
+        self.bundles: Dict[Tuple[int, int], bytes] = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytesSent = 0
+
+    def getVariant(self, index: int, recordVersion: int) -> bytes:
+        # A new record version gets new content, so its crc and size really change between versions
+        key = (index % self.variants, recordVersion)
+        if key not in self.bundles:
+            self.bundles[key] = synthetic.makeBundle(self.textures, self.size, self.sprites, self.seed + key[0] + key[1] * self.variants)
+        return self.bundles[key]
+
+    def getManifest(self, version: int) -> bytes:
+        with self.lock:
+            if version not in self.manifests:
+                recordVersions: Dict[int, int] = {}
+
+                def bundleInfo(index: int, recordVersion: int) -> Tuple[int, int]:
+                    recordVersions[index] = recordVersion
+                    bundle = self.getVariant(index, recordVersion)
+                    return zlib.crc32(bundle), len(bundle)
+
+                self.manifests[version] = synthetic.makeManifest(self.records, version, self.changed, self.seed, bundleInfo)
+                self.recordVersions[version] = recordVersions
+            return self.manifests[version]
+
+    def getBundle(self, name: str, version: Optional[int]=None) -> bytes:
+        # The bundle the manifest of this assetVersion describes, with the crc and size it lists
+        version = version if version is not None else self.latestVersion
+        self.getManifest(version)
+        index = synthetic.getAssetIndex(name)
+        with self.lock:
+            return self.getVariant(index, self.recordVersions[version].get(index, 1))
+
+    def handle(self, method: str, path: str) -> Optional[bytes]:
+        path = path.split('?')[0]
+        if method == 'POST' and path.rstrip('/').endswith('/metadata'):
+            return json.dumps({"assetVersion": self.latestVersion}).encode()
+
+        # /{version}/{platform}/{format}/{asset}
+        parts = path.strip('/').split('/')
+        if method != 'GET' or len(parts) != 4 or not parts[0].isdigit():
+            return None
+        if parts[3] == 'manifest.data':
+            return self.getManifest(int(parts[0]))
+
+        try:
+            return self.getBundle(parts[3].rsplit('.', 1)[0], int(parts[0]))
+        except (ValueError, IndexError):
+            return None
+
+    def createHandler(self) -> Callable:
+        cdn = self
+
+        class handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def respond(self, method: str):
+                if method == 'POST':
+                    self.rfile.read(int(self.headers.get('Content-Length', '0')))
+                body = cdn.handle(method, self.path)
+                if cdn.delay > 0:
+                    time.sleep(cdn.delay)
+
+                self.send_response(200 if body is not None else 404)
+                self.send_header('Content-Length', str(len(body or b'')))
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.end_headers()
+                self.wfile.write(body or b'')
+                with cdn.lock:
+                    cdn.requests += 1
+                    cdn.bytesSent += len(body or b'')
+
+            def do_GET(self):
+                self.respond('GET')
+
+            def do_POST(self):
+                self.respond('POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        return handler
+
+    def start(self, host: str='127.0.0.1', port: int=0) -> str:
+        self.server = ThreadingHTTPServer((host, port), self.createHandler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+        return f'http://{host}:{self.server.server_address[1]}'
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve synthetic manifests and bundles like the CDN, and the assetVersion like comlink')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3400)
+    parser.add_argument('--records', type=int, default=2000, help='Records per manifest')
+    parser.add_argument('--changed', type=float, default=0.05, help='Fraction of records that change every version')
+    parser.add_argument('--textures', type=int, default=4, help='Textures per bundle')
+    parser.add_argument('--size', type=int, default=256, help='Width and height of every texture')
+    parser.add_argument('--sprites', type=int, default=0, help='Sprites cut from the first texture of every bundle')
+    parser.add_argument('--latest', type=int, default=2, help='assetVersion returned by /metadata')
+    parser.add_argument('--delay', type=float, default=0.0, help='Milliseconds added to every response')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--variants', type=int, default=8, help='Distinct bundles per record version')
+    args = parser.parse_args()
+
+    cdn = stub_cdn(args.records, args.changed, args.textures, args.size, args.sprites, args.latest, args.delay / 1000, args.seed, args.variants)
+    url = cdn.start(args.host, args.port)
+    print(f'Serving on {url}, use CDN_URL={url} COMLINK_URL={url}')
+    try:
+        cdn.thread.join()
+    except KeyboardInterrupt:
+        cdn.stop()
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -0,0 +1,194 @@
+# Synthetic manifests and Unity bundles for the benchmarks, so they never need the real CDN.
+# Bundles are UnityFS files with LZ4HC blocks like the ones the CDN serves, holding uncompressed RGBA32 textures
+# and optionally sprites cut out of them.
+from typing import Callable, Dict, List, Optional, Tuple
+import random
+import struct
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helpers import ManifestDecoderHelper
+
+PREFIXES = ['charui', 'ability', 'audio', 'shared', 'icon', 'tex', 'unit', 'env']
+UNITY_VERSION = '2021.3.16f1'
+UNITY_VERSION_TUPLE = (2021, 3, 16, 1)
+TEXTURE2D = 28
+SPRITE = 213
+RGBA32 = 4
+# Unity splits bundle data into blocks of this size before compressing them
+BLOCK_SIZE = 128 * 1024
+
+def getAssetName(index: int) -> str:
+    return f'{PREFIXES[index % len(PREFIXES)]}_asset{index}'
+
+def getAssetIndex(name: str) -> int:
+    return int(name.rsplit('_asset', 1)[1])
+
+def makeManifest(records: int,
+                 version: int=1,
+                 changed: float=0.0,
+                 seed: int=1,
+                 bundleInfo: Optional[Callable[[int, int], Tuple[int, int]]]=None
+                 ) -> bytes:
+    # The same seed gives the same crcs, so two versions only differ in the records picked as changed.
+    # bundleInfo(index, recordVersion) gives the real (crc, size) of the bundle served for a record
+    rnd = random.Random(seed)
+    changes = random.Random(seed + version)
+    manifest = ManifestDecoderHelper.RawAssetManifest() # type: ignore
+    manifest.version = version
+    manifest.platform = 'Windows'
+    manifest.timestamp = 1700000000 + version
+    for i in range(records):
+        record = manifest.records.add()
+        record.name = getAssetName(i)
+        crc = rnd.getrandbits(32)
+        record.version = 1
+        if version > 1 and changes.random() < changed:
+            record.version = version
+            crc = changes.getrandbits(32)
+        record.crc = crc
+        record.size = 50000 + rnd.randrange(200000)
+        if bundleInfo is not None:
+            record.crc, record.size = bundleInfo(i, record.version)
+        record.uncompressed_size = record.size * 2
+        if i % 10 == 0 and i > 0:
+            record.dependencies.append(getAssetName(i - 1))
+        entry = record.entries.add()
+        entry.asset_name = record.name
+        entry.runtime_size = record.size
+
+    return manifest.SerializeToString()
+
+def getDefault(node):
+    from UnityPy.helpers.TypeTreeHelper import FUNCTION_WRITE_MAP
+    if node.m_Type == 'string':
+        return ''
+    if node.m_Type == 'TypelessData':
+        return b''
+    if node.m_Type in ('float', 'double'):
+        return 0.0
+    if node.m_Type == 'bool':
+        return False
+    if node.m_Type in FUNCTION_WRITE_MAP:
+        return 0
+    if node.m_Type == 'pair':
+        return tuple(getDefault(child) for child in node.m_Children)
+    if node.m_Children and node.m_Children[0].m_Type == 'Array':
+        return []
+
+    return {child.m_Name: getDefault(child) for child in node.m_Children}
+
+def writeObject(classId: int, values: Dict) -> bytes:
+    from UnityPy.helpers.Tpk import get_typetree_node
+    from UnityPy.helpers.TypeTreeHelper import write_typetree
+    from UnityPy.streams import EndianBinaryWriter
+    node = get_typetree_node(classId, UNITY_VERSION_TUPLE)
+    data = getDefault(node)
+    data.update(values)
+    writer = EndianBinaryWriter(endian='<')
+    write_typetree(data, node, writer)
+
+    return writer.bytes
+
+def makeTexture(name: str, width: int, height: int, seed: int) -> Tuple[int, bytes]:
+    # A pattern instead of noise, so the PNG encoder has about as much to do as with real game art
+    row = bytes((x * 7 + seed) & 0xFF for x in range(width * 4))
+    pixels = b''.join(row.translate(bytes((value + y * 13) & 0xFF for value in range(256))) for y in range(height))
+    return TEXTURE2D, writeObject(TEXTURE2D, {
+        "m_Name": name,
+        "m_Width": width,
+        "m_Height": height,
+        "m_TextureFormat": RGBA32,
+        "m_MipCount": 1,
+        "m_ImageCount": 1,
+        "m_TextureDimension": 2,
+        "m_CompleteImageSize": len(pixels),
+        "image data": pixels
+    })
+
+def makeSprite(name: str, texturePathId: int, x: int, y: int, width: int, height: int) -> Tuple[int, bytes]:
+    from UnityPy.helpers.Tpk import get_typetree_node
+    rect = {"x": float(x), "y": float(y), "width": float(width), "height": float(height)}
+    renderData = getDefault(get_typetree_node(SPRITE, UNITY_VERSION_TUPLE))["m_RD"]
+    renderData.update({"texture": {"m_FileID": 0, "m_PathID": texturePathId}, "textureRect": rect, "settingsRaw": 2})
+    return SPRITE, writeObject(SPRITE, {
+        "m_Name": name,
+        "m_Rect": rect,
+        "m_PixelsToUnits": 100.0,
+        "m_RD": renderData
+    })
+
+def makeSerializedFile(objects: List[Tuple[int, bytes]]) -> bytes:
+    from UnityPy.streams import EndianBinaryWriter
+    headerSize = 48
+    classes = sorted(set(classId for classId, _ in objects))
+    meta = EndianBinaryWriter(endian='<')
+    meta.write_string_to_null(UNITY_VERSION)
+    meta.write_int(19) # target platform, StandaloneWindows64
+    meta.write_boolean(False) # no type trees, UnityPy falls back to its own
+    meta.write_int(len(classes))
+    for classId in classes:
+        meta.write_int(classId)
+        meta.write_boolean(False)
+        meta.write_short(-1)
+        meta.write_bytes(b'\0' * 16)
+
+    meta.write_int(len(objects))
+    datas: List[bytes] = []
+    offset = 0
+    for pathId, (classId, data) in enumerate(objects, start=1):
+        meta.align_stream()
+        meta.write_long(pathId)
+        meta.write_long(offset)
+        meta.write_u_int(len(data))
+        meta.write_int(classes.index(classId))
+        datas.append(data + b'\0' * (-len(data) % 8))
+        offset += len(datas[-1])
+    # No script types, externals or ref types, and an empty user information string
+    meta.write_int(0)
+    meta.write_int(0)
+    meta.write_int(0)
+    meta.write_string_to_null('')
+
+    metadata = meta.bytes
+    dataOffset = headerSize + len(metadata)
+    dataOffset += -dataOffset % 16
+    body = b''.join(datas)
+    header = struct.pack('>IIII', 0, 0, 22, 0) + b'\0' * 4 + struct.pack('>IQQQ', len(metadata), dataOffset + len(body), dataOffset, 0)
+
+    return header + metadata + b'\0' * (dataOffset - headerSize - len(metadata)) + body
+
+def makeBundle(textures: int=4, size: int=256, sprites: int=0, seed: int=1) -> bytes:
+    import lz4.block
+    objects: List[Tuple[int, bytes]] = []
+    for i in range(textures):
+        objects.append(makeTexture(f'tex_{seed}_{i}', size, size, seed + i))
+    # Sprites are cut from the first texture, which has path id 1, the way atlases are
+    cell = max(1, size // max(1, sprites))
+    for i in range(sprites):
+        objects.append(makeSprite(f'sprite_{seed}_{i}', 1, (i * cell) % size, 0, cell, cell))
+    serialized = makeSerializedFile(objects)
+
+    blocks: List[Tuple[int, bytes]] = []
+    for start in range(0, len(serialized), BLOCK_SIZE):
+        chunk = serialized[start:start + BLOCK_SIZE]
+        blocks.append((len(chunk), lz4.block.compress(chunk, mode='high_compression', store_size=False)))
+
+    lz4hc = 3
+    cabName = f'CAB-{seed:032x}'
+    blocksInfo = b'\0' * 16 + struct.pack('>i', len(blocks))
+    for uncompressedSize, data in blocks:
+        blocksInfo += struct.pack('>IIH', uncompressedSize, len(data), lz4hc)
+    blocksInfo += struct.pack('>iqqI', 1, 0, len(serialized), 4) + cabName.encode() + b'\0'
+
+    header = b'UnityFS\0' + struct.pack('>I', 6) + b'5.x.x\0' + UNITY_VERSION.encode() + b'\0'
+    # Size, blocks info size compressed and not (it is stored uncompressed), and the flags: info right after the header
+    headerSize = len(header) + 20
+    padding = b'\0' * (-headerSize % 16)
+    data = b''.join(block for _, block in blocks)
+    totalSize = headerSize + len(padding) + len(blocksInfo) + len(data)
+    header += struct.pack('>qIII', totalSize, len(blocksInfo), len(blocksInfo), 0x40)
+
+    return header + padding + blocksInfo + data
\ No newline at end of file
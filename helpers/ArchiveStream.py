@@ -0,0 +1,110 @@
+# Streams /Asset/many and /Asset/getDiff as a ZIP or tar archive, one asset at a time.
+# Every asset gets a folder with its images and a metadata.json holding the manifest record and the image list.
+from helpers.TypeHelpers import BatchFormat, ImageFormat
+from helpers.Texture2DDecoder import Image, IMAGE_TYPES
+from typing import Any, AsyncIterator, Dict, List, Set, Tuple
+import tarfile
+import zipfile
+import json
+import time
+import io
+
+ARCHIVE_TYPES = {
+    BatchFormat.ZIP: ('application/zip', '.zip'),
+    BatchFormat.TAR: ('application/x-tar', '.tar')
+}
+
+class stream_buffer:
+    # zipfile and tarfile write into this, whatever they wrote is handed to the response after every asset.
+    # It has no tell or seek, which makes zipfile write data descriptors instead of going back to patch headers
+    def __init__(self):
+        self.chunks: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+class zip_writer:
+    def __init__(self, buffer: stream_buffer):
+        # PNG and WebP are already compressed, and deflating raw RGBA here would hold up the event loop
+        self.archive = zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED)
+
+    def add(self, path: str, data: bytes):
+        self.archive.writestr(zipfile.ZipInfo(path, date_time=time.localtime()[:6]), data)
+
+    def close(self):
+        self.archive.close()
+
+class tar_writer:
+    def __init__(self, buffer: stream_buffer):
+        self.archive = tarfile.open(fileobj=buffer, mode='w|') # type: ignore
+
+    def add(self, path: str, data: bytes):
+        info = tarfile.TarInfo(path)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self.archive.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        self.archive.close()
+
+def getImageFiles(images: List[Image], extension: str) -> List[str]:
+    # Object names can repeat inside a bundle and can hold characters that don't belong in a path
+    files: List[str] = []
+    used: Set[str] = set()
+    for image in images:
+        name = str(image["name"]).replace('/', '_').replace('\\', '_') or str(image["pathId"])
+        if name in used:
+            name = f'{name}_{image["pathId"]}'
+        used.add(name)
+        files.append(f'{name}{extension}')
+
+    return files
+
+def getMetadata(result: Dict[str, Any], record: Dict[str, Any], files: List[str]) -> bytes:
+    metadata: Dict[str, Any] = {"assetName": result["assetName"], "record": record}
+    if "error" in result:
+        metadata["error"] = result["error"]
+    else:
+        metadata["images"] = [{
+            "name": image["name"],
+            "file": file if image["valid"] else None,
+            "valid": image["valid"],
+            "width": image["width"],
+            "height": image["height"]
+        } for image, file in zip(result["assetData"], files)]
+
+    return json.dumps(metadata, indent=2).encode()
+
+async def archiveAssets(results: AsyncIterator[Tuple[int, Dict[str, Any]]],
+                        records: Dict[str, Dict[str, Any]],
+                        batchFormat: BatchFormat,
+                        imageFormat: ImageFormat=ImageFormat.PNG
+                        ) -> AsyncIterator[bytes]:
+    extension = IMAGE_TYPES[imageFormat][1]
+    buffer = stream_buffer()
+    writer = zip_writer(buffer) if batchFormat == BatchFormat.ZIP else tar_writer(buffer)
+
+    async for _, result in results:
+        assetName = result["assetName"]
+        images = result.get("assetData", [])
+        files = getImageFiles(images, extension)
+        for image, file in zip(images, files):
+            if image["valid"]:
+                writer.add(f'{assetName}/{file}', image["img"])
+        writer.add(f'{assetName}/metadata.json', getMetadata(result, records.get(assetName, {}), files))
+
+        data = buffer.drain()
+        if data:
+            yield data
+
+    writer.close()
+    yield buffer.drain()
\ No newline at end of file
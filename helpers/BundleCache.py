@@ -0,0 +1,102 @@
+from helpers.CacheIndex import cache_index
+from helpers.FileLock import GlobalFileLock as FileLock
+from helpers.Metrics import Metrics
+from typing import List, Optional, Tuple
+import asyncio
+import os
+
+BUNDLE_CACHE_SIZE_MB = int(os.getenv('BUNDLE_CACHE_SIZE_MB', '4096'))
+BUNDLE_CACHE_EVICT_INTERVAL = float(os.getenv('BUNDLE_CACHE_EVICT_INTERVAL', '60'))
+BUNDLE_CACHE_DIRECTORIES = ['tmp/bundles', 'tmp/manifest']
+# Files removed per pass, the loop yields between passes so eviction never holds up requests for long
+EVICT_BATCH = 50
+
+class bundle_cache(cache_index):
+    def __init__(self,
+                 directories: List[str]=BUNDLE_CACHE_DIRECTORIES,
+                 maxSize: int=BUNDLE_CACHE_SIZE_MB * 1024 * 1024,
+                 interval: float=BUNDLE_CACHE_EVICT_INTERVAL):
+        # Keyed by absolute path, exists() checks restored entries on disk before trusting them
+        super().__init__('bundleCache',
+                         'cached bundles and manifests',
+                         [os.path.abspath(directory) for directory in directories],
+                         maxSize,
+                         interval)
+        self.evicted = 0
+
+    def touch(self, filepath: str, size: Optional[int]=None):
+        path = os.path.abspath(filepath)
+        if size is None:
+            # Files that aren't indexed yet are picked up by the startup scan or the next exists()
+            if path not in self.index:
+                return
+            size = self.index[path]
+
+        self.size += size - self.index.get(path, 0)
+        self.index[path] = size
+        self.index.move_to_end(path)
+        self.unconfirmed.discard(path)
+        self.changes += 1
+
+        if self.maxSize > 0 and self.size > self.maxSize:
+            self.wakeup.set()
+
+    async def exists(self, filepath: str) -> bool:
+        path = os.path.abspath(filepath)
+        if path in self.index and path not in self.unconfirmed:
+            return True
+
+        # Only misses reach the filesystem, either the startup scan isn't done yet or another worker wrote the file
+        try:
+            size = await asyncio.to_thread(os.path.getsize, path)
+        except OSError:
+            return False
+        self.touch(path, size)
+
+        return True
+
+    def forget(self, filepath: str):
+        super().forget(os.path.abspath(filepath))
+
+    def getVictims(self, candidates: List[Tuple[str, int]], excess: int) -> List[str]:
+        # Runs in a thread, probing lock files is filesystem work too
+        victims: List[str] = []
+        for path, size in candidates:
+            if excess <= 0 or len(victims) >= EVICT_BATCH:
+                break
+            # Something is decoding or replacing this file right now
+            if FileLock.isLocked(path):
+                continue
+            victims.append(path)
+            excess -= size
+
+        return victims
+
+    async def evict(self):
+        while self.maxSize > 0 and self.size > self.maxSize:
+            victims = await asyncio.to_thread(self.getVictims, list(self.index.items()), self.size - self.maxSize)
+            if not victims:
+                self.logger.warning('Cache is over budget but every candidate is in use')
+                return
+
+            for path in victims:
+                # Removing the earlier victims awaited, so the file may have been locked since it was picked
+                if await asyncio.to_thread(FileLock.isLocked, path):
+                    continue
+                # Taken so nothing can start decoding the file while it is being removed
+                async with FileLock.claimFile(path):
+                    FileLock.discard(path)
+                    self.forget(path)
+                    try:
+                        await asyncio.to_thread(os.remove, path)
+                        self.evicted += 1
+                    except FileNotFoundError:
+                        pass
+                    except OSError as e:
+                        self.logger.warning(f'Failed to evict {path}: {e}')
+            self.logger.debug(f'Evicted {len(victims)} files, cache is at {self.size / 1024 / 1024:.1f} MiB')
+            await asyncio.sleep(0)
+
+BundleCache = bundle_cache()
+Metrics.gauge('assetapi_bundle_cache_bytes', 'Size of the cached bundles and manifests on disk', lambda: BundleCache.size)
+Metrics.gauge('assetapi_bundle_cache_evicted', 'Bundles and manifests evicted since startup', lambda: BundleCache.evicted)
\ No newline at end of file
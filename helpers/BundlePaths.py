@@ -0,0 +1,24 @@
+from helpers.TypeHelpers import AssetOS
+from typing import Any, Dict
+
+def getAssetExtension(assetName: str) -> str:
+    match assetName.split('_')[0]:
+        case 'audio':
+            return '.wwpkg'
+        case _:
+            return '.bundle'
+
+def getBundleVersion(record: Dict[str, Any]) -> str:
+    # Keyed on the content, so a bundle that is the same in a newer manifest keeps using the copy on disk
+    return f'{record["crc"]:08x}' if record["crc"] else f'v{record["version"]}'
+
+def getBundlePath(assetName: str, bundleVersion: str, assetOS: AssetOS=AssetOS.WINDOWS) -> str:
+    match assetOS:
+        case 1:
+            bundlePathFormat = 'tmp/bundles/android/{}.{}{}'
+        case 2:
+            bundlePathFormat = 'tmp/bundles/ios/{}.{}{}'
+        case _:
+            bundlePathFormat = 'tmp/bundles/windows/{}.{}{}'
+
+    return bundlePathFormat.format(assetName, bundleVersion, getAssetExtension(assetName))
\ No newline at end of file
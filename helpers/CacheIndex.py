@@ -0,0 +1,168 @@
+from helpers import Logger
+from collections import OrderedDict
+from typing import List, Optional, Set, Tuple
+import asyncio
+import json
+import time
+import uuid
+import os
+
+# How often the caches write their index to disk, it is also written on shutdown
+CACHE_INDEX_INTERVAL = float(os.getenv('CACHE_INDEX_INTERVAL', '300'))
+CACHE_INDEX_NAME = 'index.json'
+
+logger = Logger.getLogger('cacheIndex')
+
+def loadIndex(path: str) -> List[Tuple[str, int]]:
+    try:
+        with open(path, 'r') as file:
+            entries = json.load(file)
+        return [(str(key), int(size)) for key, size in entries]
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError, TypeError) as e:
+        # Only costs the order of the cache, the startup scan finds the files again
+        logger.warning(f'Ignoring unreadable cache index {path}: {e}')
+        return []
+
+def saveIndex(path: str, entries: List[Tuple[str, int]]):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Several workers write the same index, the rename makes sure a reader always gets a whole one
+    tempPath = f'{path}.{uuid.uuid4().hex}.part'
+    try:
+        with open(tempPath, 'w') as file:
+            json.dump(entries, file, separators=(',', ':'))
+        os.replace(tempPath, path)
+    finally:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+
+class cache_index:
+    # Shared by the bundle and image caches, they only differ in what they key files by and how they evict
+    def __init__(self, loggerName: str, description: str, directories: List[str], maxSize: int, interval: float):
+        self.logger = Logger.getLogger(loggerName)
+        self.description = description
+        self.directories = directories
+        self.maxSize = maxSize
+        self.interval = interval
+        # key -> size on disk, least recently used first
+        self.index: OrderedDict[str, int] = OrderedDict()
+        self.size = 0
+        self.indexPath = os.path.join(directories[0], CACHE_INDEX_NAME)
+        # Restored from the saved index but not seen on disk yet
+        self.unconfirmed: Set[str] = set()
+        # Saving before the old index was read back would replace it with only what this run used so far
+        self.restored = False
+        # Bumped on every change to the index, so it is only written to disk when something happened
+        self.changes = 0
+        self.savedChanges = 0
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def getKey(self, path: str) -> str:
+        return path
+
+    def addOldest(self, key: str, size: int):
+        self.index[key] = size
+        self.size += size
+        self.index.move_to_end(key, last=False)
+        self.changes += 1
+
+    def forget(self, key: str):
+        size = self.index.pop(key, None)
+        if size is not None:
+            self.size -= size
+            self.changes += 1
+
+    def scanFiles(self) -> List[Tuple[str, int, float]]:
+        files: List[Tuple[str, int, float]] = []
+        for directory in self.directories:
+            for dirpath, _, filenames in os.walk(directory):
+                for filename in filenames:
+                    # Files that are still being written
+                    if filename.endswith('.part') or filename == CACHE_INDEX_NAME:
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((self.getKey(path), stat.st_size, max(stat.st_atime, stat.st_mtime)))
+
+        return files
+
+    async def restore(self):
+        # The saved index keeps the order files were used in, and is there long before the scan is done
+        entries = await asyncio.to_thread(loadIndex, self.indexPath)
+        for key, size in reversed(entries):
+            if key not in self.index:
+                self.addOldest(key, size)
+                self.unconfirmed.add(key)
+        self.restored = True
+        self.logger.info(f'Restored {len(entries)} {self.description} from the saved index')
+
+    async def scan(self):
+        await self.restore()
+        files = await asyncio.to_thread(self.scanFiles)
+        # Files the saved index doesn't know are older than anything in it, so they go in front
+        for key, size, _ in sorted(files, key=lambda file: file[2], reverse=True):
+            self.unconfirmed.discard(key)
+            if key not in self.index:
+                self.addOldest(key, size)
+        # Removed while the API was down, or by another worker
+        for key in self.unconfirmed:
+            self.forget(key)
+        self.unconfirmed.clear()
+        self.changes += 1
+        self.logger.info(f'Found {len(files)} {self.description} using {self.size / 1024 / 1024:.1f} MiB')
+
+    async def saveIndex(self):
+        if not self.restored or self.changes == self.savedChanges:
+            return
+
+        changes = self.changes
+        try:
+            await asyncio.to_thread(saveIndex, self.indexPath, list(self.index.items()))
+            self.savedChanges = changes
+        except OSError as e:
+            self.logger.warning(f'Failed to save the cache index {self.indexPath}: {e}')
+
+    async def evict(self):
+        raise NotImplementedError
+
+    async def run(self):
+        await self.scan()
+        saved = time.monotonic()
+        while True:
+            try:
+                await self.evict()
+            except Exception as e:
+                self.logger.exception(f'Eviction failed: {e}')
+
+            if time.monotonic() - saved >= CACHE_INDEX_INTERVAL:
+                await self.saveIndex()
+                saved = time.monotonic()
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    def start(self):
+        # The scan also fills the index, so it runs even without a size budget
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.saveIndex()
+
+    def clear(self):
+        self.index.clear()
+        self.unconfirmed.clear()
+        self.size = 0
+        self.changes += 1
\ No newline at end of file
@@ -0,0 +1,143 @@
+from helpers import Logger, DecodeWorker
+from helpers.Metrics import Metrics
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional
+import multiprocessing
+import itertools
+import weakref
+import asyncio
+import signal
+import queue
+import time
+import os
+
+DECODE_WORKERS = int(os.getenv('DECODE_WORKERS', str(os.cpu_count() or 1)))
+DECODE_TIMEOUT = float(os.getenv('DECODE_TIMEOUT', '120'))
+DECODE_MAX_TASKS_PER_CHILD = int(os.getenv('DECODE_MAX_TASKS_PER_CHILD', '200'))
+
+decodeSeconds = Metrics.histogram('assetapi_decode_seconds', 'Time a decode task spends in the worker pool', labels=['task'])
+
+class DecodeTimeoutError(Exception):
+    pass
+
+class decode_engine:
+    def __init__(self,
+                 workers: int=DECODE_WORKERS,
+                 timeout: float=DECODE_TIMEOUT,
+                 maxTasksPerChild: int=DECODE_MAX_TASKS_PER_CHILD):
+        self.logger = Logger.getLogger('decodeEngine')
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.maxTasksPerChild = maxTasksPerChild if maxTasksPerChild > 0 else None
+        self.pool: Optional[ProcessPoolExecutor] = None
+        # Workers report the pid they run each task on, so a stuck task's worker can be killed on its own
+        self.startedQueue = None
+        self.startedOn: Dict[int, int] = {}
+        self.taskIds = itertools.count()
+        # Pools killed over a timeout, the other tasks that were running on them get resubmitted
+        self.killedPools = weakref.WeakSet()
+        # Only hand the pool as many tasks as it has workers, so the timeout covers decoding and not queueing
+        self.slots = asyncio.Semaphore(self.workers)
+        self.running = 0
+        self.waiting = 0
+
+    def start(self) -> ProcessPoolExecutor:
+        if self.pool is None:
+            # max_tasks_per_child does not work with fork, and forking a process that runs an event loop is unsafe anyway
+            context = multiprocessing.get_context('spawn')
+            self.startedQueue = context.Queue()
+            self.startedOn.clear()
+            self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                            mp_context=context,
+                                            max_tasks_per_child=self.maxTasksPerChild,
+                                            initializer=DecodeWorker.initWorker,
+                                            initargs=(self.startedQueue,))
+            self.logger.info(f'Started decode pool with {self.workers} workers')
+
+        return self.pool
+
+    async def warm(self):
+        # Workers are only spawned once there is work for them, this starts all of them so the first decodes don't wait on it
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        await asyncio.gather(*[loop.run_in_executor(self.start(), DecodeWorker.preload) for _ in range(self.workers)])
+        self.logger.info(f'Decode workers ready after {time.perf_counter() - started:.1f}s')
+
+    def readStarted(self):
+        while self.startedQueue is not None:
+            try:
+                taskId, pid = self.startedQueue.get_nowait()
+            except queue.Empty:
+                return
+            self.startedOn[taskId] = pid
+
+    async def restart(self, pool: ProcessPoolExecutor, pid: Optional[int]=None):
+        # Other tasks that failed on the same pool find it already replaced
+        if self.pool is not pool:
+            return
+        self.pool = None
+        if pid is None:
+            pool.shutdown(wait=False, cancel_futures=True)
+            self.start()
+            return
+
+        # A hung worker never finishes on its own, so it is killed instead of left running next to the new pool.
+        # The pool then fails the tasks still running on its other workers and stops them, run resubmits those
+        self.killedPools.add(pool)
+        try:
+            os.kill(pid, getattr(signal, 'SIGKILL', signal.SIGTERM))
+        except ProcessLookupError:
+            pass
+        self.start()
+        await asyncio.to_thread(pool.shutdown, True)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    async def submit(self, func: Callable[..., Any], *args: Any) -> Any:
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        started = time.perf_counter()
+        try:
+            return await self.run(func, *args)
+        finally:
+            decodeSeconds.observe(time.perf_counter() - started, func.__name__)
+            self.running -= 1
+            self.slots.release()
+
+    async def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        pool = self.start()
+        taskId = next(self.taskIds)
+        future = loop.run_in_executor(pool, DecodeWorker.runTask, taskId, func, *args)
+        timeout = self.timeout
+
+        try:
+            return await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            self.logger.error(f'{func.__name__}{args} took longer than {timeout}s, replacing the decode pool')
+            self.readStarted()
+            await self.restart(pool, self.startedOn.get(taskId))
+            raise DecodeTimeoutError(f'Decoding timed out after {timeout}s')
+        except BrokenProcessPool as e:
+            if pool in self.killedPools:
+                self.logger.warning(f'Resubmitting {func.__name__}{args}, its worker was stopped with a stuck decode')
+                return await self.run(func, *args)
+            self.logger.error(f'Decode pool broke while running {func.__name__}{args}: {e}')
+            await self.restart(pool)
+            raise
+        finally:
+            self.readStarted()
+            self.startedOn.pop(taskId, None)
+
+DecodeEngine = decode_engine()
+Metrics.gauge('assetapi_decodes_in_flight', 'Decode tasks running in the worker pool', lambda: DecodeEngine.running)
+Metrics.gauge('assetapi_decodes_queued', 'Decode tasks waiting for a free worker', lambda: DecodeEngine.waiting)
\ No newline at end of file
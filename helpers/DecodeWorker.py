@@ -0,0 +1,157 @@
+# Everything in here runs inside the DecodeEngine worker processes.
+# Keep the imports light, this module is imported by every worker on start and by the API process.
+# UnityPy takes seconds to import, so only the workers import it, in preload as each one starts.
+from helpers.TypeHelpers import ImageFormat
+from PIL import Image
+from typing import Iterator, Tuple, Dict, List, Optional, Union
+from io import BytesIO
+import time
+import os
+
+# Timings are sent back with the results so the main process can put them in /metrics
+Timings = Dict[str, List[float]]
+
+class NoAssetFoundError(Exception):
+    pass
+
+# Set by initWorker, tells the engine which worker picked up which task
+startedQueue = None
+
+def preload():
+    import UnityPy.export.Texture2DConverter
+
+def initWorker(queue):
+    global startedQueue
+    startedQueue = queue
+    preload()
+
+def runTask(taskId: int, func, *args):
+    if startedQueue is not None:
+        startedQueue.put((taskId, os.getpid()))
+    return func(*args)
+
+def encodeImage(image, imageFormat: ImageFormat=ImageFormat.PNG, quality: int=6) -> bytes:
+    if imageFormat == ImageFormat.RGBA:
+        return image.convert('RGBA').tobytes()
+
+    buffered = BytesIO()
+    match imageFormat:
+        case ImageFormat.WEBP_LOSSLESS:
+            image.save(buffered, format='WEBP', lossless=True, quality=quality)
+        case ImageFormat.WEBP:
+            image.save(buffered, format='WEBP', quality=quality)
+        case _:
+            image.save(buffered, format='PNG', compress_level=quality)
+
+    return buffered.getvalue()
+
+def newTimings() -> Timings:
+    return {"load": [], "decode": [], "encode": []}
+
+def loadTimed(filepath: str, timings: Timings):
+    # UnityPy.load treats a missing path as an empty bundle
+    if not os.path.isfile(filepath):
+        raise FileNotFoundError(filepath)
+    import UnityPy
+    started = time.perf_counter()
+    env = UnityPy.load(filepath)
+    timings["load"].append(time.perf_counter() - started)
+
+    return env
+
+IMAGE_TYPES = ["Texture2D", "Sprite"]
+
+def selectObjects(env, names: Optional[List[str]]=None, types: Optional[List[str]]=None) -> Iterator:
+    # Filtering on the type and the peeked name means objects nobody asked for are never read
+    wanted = set(names) if names else None
+    for obj in env.objects:
+        if obj.type.name not in IMAGE_TYPES or (types and obj.type.name not in types):
+            continue
+        if wanted is not None and obj.peek_name() not in wanted:
+            continue
+        yield obj
+
+def getImage(obj, data) -> Image.Image:
+    if obj.type.name != "Texture2D":
+        return data.image
+
+    # UnityPy keeps the unflipped textures it cut sprites out of in this cache. Sharing it means an atlas
+    # is decoded once per load, no matter if the texture or its sprites are asked for first
+    cache = getattr(obj.assets_file, '_cache', {})
+    image = cache.get(obj.path_id)
+    if image is None:
+        from UnityPy.export.Texture2DConverter import get_image_from_texture2d
+        image = get_image_from_texture2d(data, False)
+        cache[obj.path_id] = image
+
+    return image.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+
+def imageTimed(obj, data, timings: Timings, imageFormat: ImageFormat, quality: int) -> Tuple[bytes, int, int]:
+    started = time.perf_counter()
+    image = getImage(obj, data)
+    decoded = time.perf_counter()
+    encoded = encodeImage(image, imageFormat, quality)
+    timings["decode"].append(decoded - started)
+    timings["encode"].append(time.perf_counter() - decoded)
+
+    return encoded, image.width, image.height
+
+def decodeFirst(filepath: str,
+                imageFormat: ImageFormat=ImageFormat.PNG,
+                quality: int=6,
+                names: Optional[List[str]]=None,
+                types: Optional[List[str]]=None
+                ) -> Tuple[Dict[str, Union[str, bytes, bool, int]], Timings]:
+    timings = newTimings()
+    env = loadTimed(filepath, timings)
+
+    for obj in selectObjects(env, names, types):
+        data = obj.read()
+        encoded, width, height = imageTimed(obj, data, timings, imageFormat, quality)
+
+        return {"name": data.m_Name, "pathId": obj.path_id, "type": obj.type.name, "img": encoded, "valid": True, "width": width, "height": height}, timings
+
+    raise NoAssetFoundError(f'No supported assets found in {filepath}')
+
+def decodeAll(filepath: str,
+              imageFormat: ImageFormat=ImageFormat.PNG,
+              quality: int=6,
+              names: Optional[List[str]]=None,
+              types: Optional[List[str]]=None
+              ) -> Tuple[List[Dict[str, Union[str, bytes, bool, int]]], Timings]:
+    timings = newTimings()
+    env = loadTimed(filepath, timings)
+
+    response: List[Dict[str, Union[str, bytes, bool, int]]] = []
+    for obj in selectObjects(env, names, types):
+        data = obj.read()
+        img_name = data.m_Name
+        # This if statment is to catch empty images such as in shared_resourcecontainer.bundle "Font Texture"
+        # Not catching these causes a PermissionError when running data.image
+        # The error stems from not having m_StreamData.path or another format that may be used
+        # To ensure that an asset exists please check "pass"
+        if obj.type.name == "Texture2D":
+            if data.m_StreamData.path == "" and data.m_ImageCount == 0 and data.m_Width == 0:
+                response.append({
+                    "name": img_name,
+                    "pathId": obj.path_id,
+                    "type": obj.type.name,
+                    "img": b"",
+                    "valid": False,
+                    "width": 0,
+                    "height": 0
+                })
+                continue
+
+        encoded, width, height = imageTimed(obj, data, timings, imageFormat, quality)
+        response.append({
+            "name": img_name,
+            "pathId": obj.path_id,
+            "type": obj.type.name,
+            "img": encoded,
+            "valid": True,
+            "width": width,
+            "height": height
+        })
+
+    return response, timings
\ No newline at end of file
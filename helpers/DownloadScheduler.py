@@ -0,0 +1,196 @@
+from helpers.TypeHelpers import Priority
+from contextlib import asynccontextmanager
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Tuple
+import itertools
+import asyncio
+import time
+import os
+
+CDN_MAX_CONCURRENT = int(os.getenv('CDN_MAX_CONCURRENT', '16'))
+CDN_BULK_CONCURRENT = int(os.getenv('CDN_BULK_CONCURRENT', '8'))
+PREWARM_CONCURRENCY = int(os.getenv('PREWARM_CONCURRENCY', '2'))
+CDN_BANDWIDTH_KB = int(os.getenv('CDN_BANDWIDTH_KB', '0'))
+CDN_BULK_BANDWIDTH_KB = int(os.getenv('CDN_BULK_BANDWIDTH_KB', '0'))
+PREWARM_BANDWIDTH_KB = int(os.getenv('PREWARM_BANDWIDTH_KB', '0'))
+# Throughput is reported as the average over this many seconds
+THROUGHPUT_WINDOW = 10
+
+class token_bucket:
+    def __init__(self, rate: int):
+        # Holds at most one second worth of tokens, so an idle bucket can't be used for a huge burst
+        self.rate = rate
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        # (priority, seq, amount, future) for everyone waiting for the bucket to get out of debt
+        self.waiting: List[Tuple[Priority, int, int, asyncio.Future]] = []
+        self.seq = itertools.count()
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def consume(self, amount: int, priority: Priority=Priority.INTERACTIVE):
+        if self.rate <= 0:
+            return
+
+        self.refill()
+        # Going into debt means whoever comes next waits for everything booked before them
+        if not self.waiting and self.tokens >= 0:
+            self.tokens -= amount
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = (priority, next(self.seq), amount, future)
+        self.waiting.append(waiter)
+        self.grant()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if waiter in self.waiting:
+                self.waiting.remove(waiter)
+            raise
+
+    def grant(self):
+        # Once the debt is paid off the most important waiter goes next, oldest first
+        self.refill()
+        while self.waiting and self.tokens >= 0:
+            waiter = min(self.waiting, key=lambda waiting: waiting[:2])
+            self.waiting.remove(waiter)
+            self.tokens -= waiter[2]
+            if not waiter[3].done():
+                waiter[3].set_result(None)
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.waiting:
+            self.timer = asyncio.get_running_loop().call_later(-self.tokens / self.rate, self.grant)
+
+class download_ticket:
+    def __init__(self, priority: Priority, seq: int):
+        # The priority can be raised while waiting, when a more important request joins the same download
+        self.priority = priority
+        self.seq = seq
+        self.startedAs: Optional[Priority] = None
+        self.future: Optional[asyncio.Future] = None
+
+    def raisePriority(self, priority: Priority):
+        if priority < self.priority:
+            self.priority = priority
+
+class download_scheduler:
+    def __init__(self,
+                 maxConcurrent: int=CDN_MAX_CONCURRENT,
+                 limits: Optional[Dict[Priority, int]]=None,
+                 bandwidthKB: int=CDN_BANDWIDTH_KB,
+                 bandwidthsKB: Optional[Dict[Priority, int]]=None):
+        self.maxConcurrent = max(1, maxConcurrent)
+        # 0 means the priority is only limited by maxConcurrent
+        self.limits = limits if limits is not None else {Priority.BULK: CDN_BULK_CONCURRENT, Priority.PREWARM: PREWARM_CONCURRENCY}
+        bandwidthsKB = bandwidthsKB if bandwidthsKB is not None else {Priority.BULK: CDN_BULK_BANDWIDTH_KB, Priority.PREWARM: PREWARM_BANDWIDTH_KB}
+        self.bucket = token_bucket(bandwidthKB * 1024)
+        self.buckets = {priority: token_bucket(kb * 1024) for priority, kb in bandwidthsKB.items()}
+        self.active = 0
+        self.activeBy: Dict[Priority, int] = {priority: 0 for priority in Priority}
+        self.waiting: List[download_ticket] = []
+        self.seq = itertools.count()
+        self.totalBytes = 0
+        self.completed = 0
+        # (second, bytes) for the last THROUGHPUT_WINDOW seconds
+        self.samples: Deque[Tuple[int, int]] = deque()
+
+    def createTicket(self, priority: Priority) -> download_ticket:
+        return download_ticket(priority, next(self.seq))
+
+    def canStart(self, priority: Priority) -> bool:
+        limit = self.limits.get(priority, 0)
+        return self.active < self.maxConcurrent and (limit <= 0 or self.activeBy[priority] < limit)
+
+    def start(self, ticket: download_ticket):
+        ticket.startedAs = ticket.priority
+        self.active += 1
+        self.activeBy[ticket.priority] += 1
+
+    def release(self, ticket: download_ticket):
+        if ticket.startedAs is not None:
+            self.active -= 1
+            self.activeBy[ticket.startedAs] -= 1
+            ticket.startedAs = None
+        self.completed += 1
+        self.wake()
+
+    def wake(self):
+        # Hand free slots to the most important waiter that its priority limit allows, oldest first
+        while self.waiting:
+            eligible = [ticket for ticket in self.waiting if self.canStart(ticket.priority)]
+            if not eligible:
+                break
+            ticket = min(eligible, key=lambda waiter: (waiter.priority, waiter.seq))
+            self.waiting.remove(ticket)
+            self.start(ticket)
+            if ticket.future is not None and not ticket.future.done():
+                ticket.future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, ticket: download_ticket) -> AsyncIterator[None]:
+        ticket.future = asyncio.get_running_loop().create_future()
+        self.waiting.append(ticket)
+        self.wake()
+
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+            else:
+                self.release(ticket)
+            raise
+
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+    async def consume(self, ticket: download_ticket, amount: int):
+        self.record(amount)
+        bucket = self.buckets.get(ticket.priority)
+        if bucket is not None:
+            await bucket.consume(amount)
+        # Interactive traffic counts against the global limit too, but goes ahead of bulk and prewarm traffic waiting on it
+        await self.bucket.consume(amount, ticket.priority)
+
+    def record(self, amount: int):
+        now = int(time.monotonic())
+        self.totalBytes += amount
+        if self.samples and self.samples[-1][0] == now:
+            self.samples[-1] = (now, self.samples[-1][1] + amount)
+        else:
+            self.samples.append((now, amount))
+        while self.samples and self.samples[0][0] <= now - THROUGHPUT_WINDOW:
+            self.samples.popleft()
+
+    def getThroughput(self) -> float:
+        now = int(time.monotonic())
+        return sum(amount for second, amount in self.samples if second > now - THROUGHPUT_WINDOW) / THROUGHPUT_WINDOW
+
+    def getCounts(self) -> Dict[Tuple[str, str], float]:
+        counts: Dict[Tuple[str, str], float] = {}
+        for priority in Priority:
+            counts[('active', priority.name.lower())] = self.activeBy[priority]
+            counts[('queued', priority.name.lower())] = sum(1 for ticket in self.waiting if ticket.priority == priority)
+
+        return counts
+
+    def getStats(self) -> Dict[str, Any]:
+        return {
+            "active": self.active,
+            "queued": len(self.waiting),
+            "activeByPriority": {priority.name.lower(): self.activeBy[priority] for priority in Priority},
+            "queuedByPriority": {priority.name.lower(): sum(1 for ticket in self.waiting if ticket.priority == priority) for priority in Priority},
+            "completed": self.completed,
+            "totalBytes": self.totalBytes,
+            "bytesPerSecond": self.getThroughput()
+        }
\ No newline at end of file
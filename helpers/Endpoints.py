@@ -1,230 +1,422 @@
 from fastapi import Response, HTTPException
-from helpers import Texture2DDecoder, ManifestDecoder, ManifestDiff, Logger
+from fastapi.responses import StreamingResponse
+from helpers import Texture2DDecoder, ManifestDecoder, ManifestDiff, ArchiveStream, EventStream, Logger
 from helpers.RequestManager import RequestManager
-from helpers.FileLock import GlobalFileLock as FileLock
-from helpers.TypeHelpers import AssetOS, DiffVersion
-from typing import Dict, Union, List, Any
-import aiofiles
-import json
+from helpers.DecodeEngine import DecodeEngine
+from helpers.Metrics import cacheRequests
+from helpers.BundleCache import BundleCache
+from helpers.BundlePaths import getAssetExtension, getBundleVersion, getBundlePath
+from helpers.TypeHelpers import AssetOS, DiffVersion, DependencyMode, Priority, BatchFormat, ImageFormat, ObjectType
+from typing import Dict, Union, List, AsyncIterator, Tuple, Set, Optional, Any, BinaryIO
+from email.utils import formatdate, parsedate_to_datetime
+import itertools
+import asyncio
 import os
-import io
 
 logger = Logger.getLogger('Endpoints')
 
+DOWNLOAD_CONCURRENCY = int(os.getenv('DOWNLOAD_CONCURRENCY', '8'))
+BUNDLE_CHUNK_SIZE = 256 * 1024
+
+async def getRecord(assetName: str, version: int, assetOS: AssetOS) -> Dict[str, Any]:
+    record = await ManifestDecoder.getRecord(assetName, version, assetOS)
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"{assetName} is not in the manifest for version {version}")
+
+    return record
+
+def getEncoding(imageFormat: ImageFormat, quality: Optional[int]) -> Texture2DDecoder.Encoding:
+    try:
+        return Texture2DDecoder.getEncoding(imageFormat, quality)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def fetchAndDecode(assetName: str, 
+                         version: int, 
+                         forceReDownload: bool, 
+                         assetOS: AssetOS, 
+                         downloadLimit: asyncio.Semaphore, 
+                         record: Optional[Dict[str, Any]]=None, 
+                         priority: Priority=Priority.INTERACTIVE, 
+                         encoding: Texture2DDecoder.Encoding=Texture2DDecoder.DEFAULT_ENCODING, 
+                         selection: Texture2DDecoder.Selection=Texture2DDecoder.NO_SELECTION
+                         ) -> Dict[str, Union[str, List[Texture2DDecoder.Image]]]:
+    if record is None:
+        return {"assetName": assetName, "error": f"{assetName} is not in the manifest for version {version}"}
+
+    assetExtension = getAssetExtension(assetName)
+    bundleVersion = getBundleVersion(record)
+    asset_path = getBundlePath(assetName, bundleVersion, assetOS)
+
+    if forceReDownload or not await BundleCache.exists(asset_path):
+        cacheRequests.inc('bundle', 'miss')
+        async with downloadLimit:
+            logger.debug(f'Downloading {assetName}{assetExtension}')
+            try:
+                await RequestManager.getSaveAsset(assetName + assetExtension, version, asset_path, assetOS, record['crc'], record['size'], priority)
+            except Exception as e:
+                detail = e.detail if isinstance(e, HTTPException) else str(e)
+                logger.warning(f"Failed to download asset {assetName}: {detail}")
+                return {"assetName": assetName, "error": detail}
+    else:
+        cacheRequests.inc('bundle', 'hit')
+    BundleCache.touch(asset_path)
+
+    try:
+        return {"assetName": assetName, "assetData": await Texture2DDecoder.decodeManyImages(asset_path, assetName, bundleVersion, assetOS, forceReDownload, encoding, selection)}
+    except Exception as e:
+        logger.exception(f"Failed to decode asset {assetName}: {e}")
+        return {"assetName": assetName, "error": str(e)}
+
+async def iterAssets(assetNames: List[str], 
+                     version: int, 
+                     forceReDownload: bool=False, 
+                     assetOS: AssetOS=AssetOS.WINDOWS, 
+                     records: Optional[Dict[str, Dict[str, Any]]]=None, 
+                     priority: Priority=Priority.INTERACTIVE, 
+                     encoding: Texture2DDecoder.Encoding=Texture2DDecoder.DEFAULT_ENCODING, 
+                     selection: Texture2DDecoder.Selection=Texture2DDecoder.NO_SELECTION
+                     ) -> AsyncIterator[Tuple[int, Dict[str, Union[str, List[Texture2DDecoder.Image]]]]]:
+    # Yields (index, result) as soon as each asset is done. Only a window of assets is in flight at once,
+    # enough to keep the downloads and the decode pool busy without holding every result in memory
+    downloadLimit = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+    window = DOWNLOAD_CONCURRENCY + DecodeEngine.workers
+
+    async def indexed(index: int, assetName: str):
+        record = records.get(assetName) if records else None
+        return index, await fetchAndDecode(assetName, version, forceReDownload, assetOS, downloadLimit, record, priority, encoding, selection)
+
+    queue = iter(enumerate(assetNames))
+    pending: Set[asyncio.Task] = set()
+    try:
+        while True:
+            for index, assetName in itertools.islice(queue, window - len(pending)):
+                pending.add(asyncio.create_task(indexed(index, assetName)))
+            if not pending:
+                break
+
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def collectAssets(assetNames: List[str], 
+                        version: int, 
+                        forceReDownload: bool=False, 
+                        assetOS: AssetOS=AssetOS.WINDOWS, 
+                        records: Optional[Dict[str, Dict[str, Any]]]=None, 
+                        priority: Priority=Priority.INTERACTIVE, 
+                        encoding: Texture2DDecoder.Encoding=Texture2DDecoder.DEFAULT_ENCODING, 
+                        selection: Texture2DDecoder.Selection=Texture2DDecoder.NO_SELECTION
+                        ) -> List[Dict[str, Union[str, List[Dict[str, Union[str, bool, int]]]]]]:
+    response: List[Dict[str, Union[str, List[Dict[str, Union[str, bool, int]]]]]] = [{} for _ in assetNames]
+    async for index, result in iterAssets(assetNames, version, forceReDownload, assetOS, records, priority, encoding, selection):
+        if "assetData" in result:
+            response[index] = {"assetName": result["assetName"], "assetData": Texture2DDecoder.toDataUris(result["assetData"], encoding[0])}
+        else:
+            response[index] = result
+
+    return response
+
+def streamAssets(assetNames: List[str], 
+                 version: int, 
+                 forceReDownload: bool, 
+                 assetOS: AssetOS, 
+                 records: Dict[str, Dict[str, Any]], 
+                 priority: Priority, 
+                 batchFormat: BatchFormat, 
+                 filename: str, 
+                 encoding: Texture2DDecoder.Encoding, 
+                 selection: Texture2DDecoder.Selection=Texture2DDecoder.NO_SELECTION, 
+                 headers: Optional[Dict[str, str]]=None
+                 ) -> StreamingResponse:
+    # Assets are sent in the order they finish, not the order they were asked for
+    results = iterAssets(assetNames, version, forceReDownload, assetOS, records, priority, encoding, selection)
+    if batchFormat in ArchiveStream.ARCHIVE_TYPES:
+        mediaType, extension = ArchiveStream.ARCHIVE_TYPES[batchFormat]
+        return StreamingResponse(
+            ArchiveStream.archiveAssets(results, records, batchFormat, encoding[0]),
+            media_type=mediaType,
+            headers={**(headers or {}), "Content-Disposition": f'attachment; filename="{filename}{extension}"'}
+        )
+
+    return StreamingResponse(
+        EventStream.streamEvents(results, len(assetNames), batchFormat, encoding[0]),
+        media_type=EventStream.EVENT_TYPES[batchFormat],
+        headers={**(headers or {}), **EventStream.EVENT_HEADERS}
+    )
+
 async def assetSingle(version: int, 
                       assetName: str, 
                       forceReDownload: bool=False, 
-                      assetOS: AssetOS=AssetOS.WINDOWS
+                      assetOS: AssetOS=AssetOS.WINDOWS, 
+                      imageFormat: ImageFormat=ImageFormat.PNG, 
+                      quality: Optional[int]=None, 
+                      objectName: Optional[str]=None, 
+                      objectType: ObjectType=ObjectType.ALL
                       ) -> Response:
-    match assetOS:
-        case 1:
-            bundlePathFormat = 'tmp/bundles/android/{}{}'
-        case 2:
-            bundlePathFormat = 'tmp/bundles/ios/{}{}'
-        case _:
-            bundlePathFormat = 'tmp/bundles/windows/{}{}'
-
-    match assetName.split('_')[0]:
-            case 'audio':
-                assetExtension = '.wwpkg'
-            case _:
-                assetExtension = '.bundle'
-
-    bundlePath = bundlePathFormat.format(assetName, assetExtension)
-
-    if not os.path.isfile(bundlePath) or forceReDownload:
+    encoding = getEncoding(imageFormat, quality)
+    selection = Texture2DDecoder.getSelection([objectName] if objectName else None, objectType)
+    assetExtension = getAssetExtension(assetName)
+    record = await getRecord(assetName, version, assetOS)
+    bundleVersion = getBundleVersion(record)
+    bundlePath = getBundlePath(assetName, bundleVersion, assetOS)
+
+    if forceReDownload or not await BundleCache.exists(bundlePath):
+        cacheRequests.inc('bundle', 'miss')
         logger.debug(f'Downloading {assetName}{assetExtension}')
         try:
-            await RequestManager.getSaveAsset(assetName + assetExtension, version, bundlePath)
+            await RequestManager.getSaveAsset(assetName + assetExtension, version, bundlePath, assetOS, record['crc'], record['size'])
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
+    else:
+        cacheRequests.inc('bundle', 'hit')
+    BundleCache.touch(bundlePath)
 
-    image, returnName = await Texture2DDecoder.decodeAsset(bundlePath)
-    img_bytes = io.BytesIO()
-    image.save(img_bytes, format="PNG")
-    img_bytes.seek(0)
+    try:
+        image = await Texture2DDecoder.decodeAsset(bundlePath, assetName, bundleVersion, assetOS, forceReDownload, encoding, selection)
+    except Texture2DDecoder.NoAssetFoundError:
+        raise HTTPException(status_code=404, detail=f"No matching Texture2D or Sprite found in {assetName}")
+    except FileNotFoundError:
+        # Removed by another worker or /cleanup after it was looked up, asking again downloads it
+        raise HTTPException(status_code=503, detail=f"{assetName} was removed from the cache while decoding, try again")
+    mediaType, extension, _, _ = Texture2DDecoder.IMAGE_TYPES[imageFormat]
 
     return Response(
-        content=img_bytes.getvalue(),
-        media_type="image/png",
-        headers={"Content-Disposition": f'attachment; filename="{returnName + '.png'}"'}
+        content=image["img"],
+        media_type=mediaType,
+        headers={
+            "Content-Disposition": f'attachment; filename="{image["name"]}{extension}"',
+            "X-Image-Width": str(image["width"]),
+            "X-Image-Height": str(image["height"])
+        }
     )
 
 async def assetMany(version: int, 
                     assetNames: str, 
                     forceReDownload: bool=False, 
-                    assetOS: AssetOS=AssetOS.WINDOWS
-                    ) -> List[Dict[str, Union[str, List[Dict[str, Union[str, bool]]]]]]:
-    match assetOS:
-        case 1:
-            assetPath = 'tmp/bundles/android/{}{}'
-        case 2:
-            assetPath = 'tmp/bundles/ios/{}{}'
-        case _:
-            assetPath = 'tmp/bundles/windows/{}{}'
-            
-    response = []
+                    assetOS: AssetOS=AssetOS.WINDOWS, 
+                    batchFormat: BatchFormat=BatchFormat.JSON, 
+                    imageFormat: ImageFormat=ImageFormat.PNG, 
+                    quality: Optional[int]=None, 
+                    objectNames: Optional[str]=None, 
+                    objectType: ObjectType=ObjectType.ALL
+                    ) -> Union[List[Dict[str, Union[str, List[Dict[str, Union[str, bool, int]]]]]], Response]:
+    encoding = getEncoding(imageFormat, quality)
     assetNamesList = [name.strip() for name in assetNames.split(',') if name.strip()]
+    objectNamesList = [name.strip() for name in objectNames.split(',') if name.strip()] if objectNames else None
+    selection = Texture2DDecoder.getSelection(objectNamesList, objectType)
+    manifest = await ManifestDecoder.getManifest(version, assetOS)
 
-    for assetName in assetNamesList:
-        match assetName.split('_')[0]:
-            case 'audio':
-                assetExtension = '.wwpkg'
-            case _:
-                assetExtension = '.bundle'
-        asset_path = assetPath.format(assetName, assetExtension)
-        if not os.path.isfile(asset_path) or forceReDownload:
-            logger.debug(f'Downloading {assetName}{assetExtension}')
-            try:
-                await RequestManager.getSaveAsset(assetName+assetExtension, version, asset_path)
-            except Exception as e:
-                raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
+    if batchFormat != BatchFormat.JSON:
+        return streamAssets(assetNamesList, version, forceReDownload, assetOS, manifest.byName, Priority.INTERACTIVE, batchFormat, f'assets_{version}', encoding, selection)
 
-        try:
-            response.append({"assetName": assetName, "assetData": await Texture2DDecoder.decodeManyAssets(asset_path)})
-        except Exception as e:
-            logger.exception(f"Failed to decode asset {assetName}: {e}")
-            response.append({"error": str(e)})
-
-    return response
+    return await collectAssets(assetNamesList, version, forceReDownload, assetOS, manifest.byName, Priority.INTERACTIVE, encoding, selection)
 
 async def assetList(version: int, 
                     forceReDownload: bool=False, 
                     assetOS: AssetOS=AssetOS.WINDOWS
                     ) -> List[str]:
-    if os.path.isfile(f'tmp/manifest/manifest_{assetOS}_{version}.json') and not forceReDownload:
-        async with FileLock.claimFile(os.path.abspath(f'tmp/manifest/manifest_{assetOS}_{version}.json')):
-            async with aiofiles.open(f'tmp/manifest/manifest_{assetOS}_{version}.json', 'r') as file:
-                content = await file.read()
-                
-                entries = json.loads(content)
-                response = []
-                for entry in entries:
-                    response.append(entry['name'])
-                    
-                return response
+    return (await ManifestDecoder.getManifest(version, assetOS, forceReDownload)).names
+    
+async def getDiffNames(version: int, 
+                       diffVersion: int, 
+                       forceReDownload: bool, 
+                       diffType: DiffVersion, 
+                       prefix: str, 
+                       assetOS: AssetOS, 
+                       dependencyMode: DependencyMode, 
+                       skipUnchanged: bool
+                       ) -> Tuple[List[str], ManifestDecoder.ParsedManifest]:
+    recordPrefix = prefix if prefix != 'None' else None
+    if recordPrefix is not None and dependencyMode == DependencyMode.NONE and not forceReDownload:
+        # Only the prefix is needed, a stored manifest gives just those rows
+        newManifest = await ManifestDecoder.getPrefixManifest(version, assetOS, recordPrefix)
+        oldManifest = await ManifestDecoder.getPrefixManifest(diffVersion, assetOS, recordPrefix)
     else:
-        logger.debug("Couldn't find manifest or user requested a new one")
+        newManifest = await ManifestDecoder.getManifest(version, assetOS, forceReDownload)
+        oldManifest = await ManifestDecoder.getManifest(diffVersion, assetOS, forceReDownload)
+
+    names = ManifestDiff.compareManifest(newManifest.getRecords(recordPrefix), oldManifest.getRecords(recordPrefix), diffType, skipUnchanged)
+    # Dependencies can live outside of the prefix, so the walk uses the whole manifest
+    if dependencyMode != DependencyMode.NONE:
+        names = newManifest.expandNames(names, dependencyMode)
+
+    return names, newManifest
+
+def setDownloadSize(response: Optional[Response], manifest: ManifestDecoder.ParsedManifest, names: List[str]):
+    if response is not None:
+        response.headers['X-Total-Download-Size'] = str(manifest.getDownloadSize(names))
 
-        return await ManifestDecoder.getAssetManifest(version, assetOS)
-    
 async def assetListDiff(version: int, 
                         diffVersion: int, 
                         forceReDownload: bool=False, 
                         diffType: DiffVersion=DiffVersion.ALL, 
                         prefix: str='None', 
-                        assetOS: AssetOS=AssetOS.WINDOWS
+                        assetOS: AssetOS=AssetOS.WINDOWS, 
+                        dependencyMode: DependencyMode=DependencyMode.NONE, 
+                        skipUnchanged: bool=False, 
+                        response: Optional[Response]=None
                         ) -> List[str]:
-    if not os.path.isfile(f'tmp/manifest/manifest_{assetOS}_{version}.json') or forceReDownload:
-        logger.debug("Couldn't find manifest or user requested a new one")
-        await ManifestDecoder.getAssetManifestBlocking(version, assetOS)
-    if not os.path.isfile(f'tmp/manifest/manifest_{assetOS}_{diffVersion}.json') or forceReDownload:
-        logger.debug("Couldn't find manifest or user requested a new one")
-        await ManifestDecoder.getAssetManifestBlocking(diffVersion, assetOS)
-    async with FileLock.claimFile(os.path.abspath(f'tmp/manifest/manifest_{assetOS}_{version}.json')):
-        async with aiofiles.open(f'tmp/manifest/manifest_{assetOS}_{version}.json', 'r') as file:
-            content = await file.read()
-            newManifest: List[Dict[str, Any]] = json.loads(content)
-    async with FileLock.claimFile(os.path.abspath(f'tmp/manifest/manifest_{assetOS}_{diffVersion}.json')):
-        async with aiofiles.open(f'tmp/manifest/manifest_{assetOS}_{diffVersion}.json', 'r') as file:
-            content = await file.read()
-            oldManifest: List[Dict[str, Any]] = json.loads(content)
-
-    return ManifestDiff.compareManifest(newManifest, oldManifest, diffType, prefix)
+    names, newManifest = await getDiffNames(version, diffVersion, forceReDownload, diffType, prefix, assetOS, dependencyMode, skipUnchanged)
+    setDownloadSize(response, newManifest, names)
+
+    return names
 
 async def assetGetDiff(version: int, 
                        diffVersion: int, 
                        forceReDownload: bool=False, 
                        diffType: DiffVersion=DiffVersion.ALL, 
                        prefix: str='None', 
-                       assetOS: AssetOS=AssetOS.WINDOWS
-                       ) -> List[Dict[str, Union[str, List[Dict[str, Union[str, bool]]]]]]:
-    if not os.path.isfile(f'tmp/manifest/manifest_{assetOS}_{version}.json') or forceReDownload:
-        logger.debug("Couldn't find manifest or user requested a new one")
-        await ManifestDecoder.getAssetManifestBlocking(version, assetOS)
-    if not os.path.isfile(f'tmp/manifest/manifest_{assetOS}_{diffVersion}.json') or forceReDownload:
-        logger.debug("Couldn't find manifest or user requested a new one")
-        await ManifestDecoder.getAssetManifestBlocking(diffVersion, assetOS)
-    async with FileLock.claimFile(os.path.abspath(f'tmp/manifest/manifest_{assetOS}_{version}.json')):
-        async with aiofiles.open(f'tmp/manifest/manifest_{assetOS}_{version}.json', 'r') as file:
-            content = await file.read()
-            newManifest: List[Dict[str, Any]] = json.loads(content)
-    async with FileLock.claimFile(os.path.abspath(f'tmp/manifest/manifest_{assetOS}_{diffVersion}.json')):
-        async with aiofiles.open(f'tmp/manifest/manifest_{assetOS}_{diffVersion}.json', 'r') as file:
-            content = await file.read()
-            oldManifest: List[Dict[str, Any]] = json.loads(content)
-    
-    newAssets = ManifestDiff.compareManifest(newManifest, oldManifest, diffType, prefix)
-
-    match assetOS:
-        case 1:
-            assetPath = 'tmp/bundles/android/{}{}'
-        case 2:
-            assetPath = 'tmp/bundles/ios/{}{}'
-        case _:
-            assetPath = 'tmp/bundles/windows/{}{}'
-            
-    response = []
-    for assetName in newAssets:
-        match assetName.split('_')[0]:
-            case 'audio':
-                assetExtension = '.wwpkg'
-            case _:
-                assetExtension = '.bundle'
-
-        asset_path = assetPath.format(assetName, assetExtension)
-
-        if not os.path.isfile(asset_path) or forceReDownload:
-            logger.debug(f'Downloading {assetName}{assetExtension}')
-            try:
-                await RequestManager.getSaveAsset(assetName+assetExtension, version, asset_path)
-            except Exception as e:
-                raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
+                       assetOS: AssetOS=AssetOS.WINDOWS, 
+                       dependencyMode: DependencyMode=DependencyMode.NONE, 
+                       skipUnchanged: bool=False, 
+                       response: Optional[Response]=None, 
+                       batchFormat: BatchFormat=BatchFormat.JSON, 
+                       imageFormat: ImageFormat=ImageFormat.PNG, 
+                       quality: Optional[int]=None
+                       ) -> Union[List[Dict[str, Union[str, List[Dict[str, Union[str, bool, int]]]]]], Response]:
+    encoding = getEncoding(imageFormat, quality)
+    newAssets, newManifest = await getDiffNames(version, diffVersion, forceReDownload, diffType, prefix, assetOS, dependencyMode, skipUnchanged)
+    if batchFormat != BatchFormat.JSON:
+        # The injected response's headers are not used when a response is returned, so the size goes on the stream itself
+        headers = {"X-Total-Download-Size": str(newManifest.getDownloadSize(newAssets))}
+        return streamAssets(newAssets, version, forceReDownload, assetOS, newManifest.byName, Priority.BULK, batchFormat, f'diff_{diffVersion}_{version}', encoding, headers=headers)
 
-        try:
-            response.append({"assetName": assetName, "assetData": await Texture2DDecoder.decodeManyAssets(asset_path)})
-        except Exception as e:
-            logger.exception(f"Failed to decode asset {assetName}: {e}")
-            response.append({"error": str(e)})
-    
-    return response
+    setDownloadSize(response, newManifest, newAssets)
+
+    return await collectAssets(newAssets, version, forceReDownload, assetOS, newManifest.byName, Priority.BULK, encoding)
+
+def openBundle(filepath: str) -> Tuple[BinaryIO, os.stat_result]:
+    file = open(filepath, 'rb')
+
+    return file, os.fstat(file.fileno())
+
+def notModifiedSince(ifModifiedSince: Optional[str], modified: float) -> bool:
+    try:
+        since = parsedate_to_datetime(ifModifiedSince) if ifModifiedSince else None
+    except (TypeError, ValueError):
+        since = None
+    # Dates that can't be parsed are ignored, the HTTP date only has whole seconds
+    return since is not None and int(modified) <= since.timestamp()
+
+def getRange(rangeHeader: Optional[str], ifRange: Optional[str], validators: List[str], size: int) -> Optional[Tuple[int, int]]:
+    # Only a single range is served. Anything else, or a header that isn't valid, gets the whole bundle as RFC 9110 asks
+    if rangeHeader is None or (ifRange is not None and ifRange.strip() not in validators):
+        return None
+    unit, _, spec = rangeHeader.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, _, last = (part.strip() for part in spec.partition('-'))
+    if not (first or last) or (first and not first.isdigit()) or (last and not last.isdigit()):
+        return None
+
+    if first:
+        start, end = int(first), int(last) if last else size - 1
+        if last and end < start:
+            return None
+    else:
+        start, end = max(0, size - int(last)), size - 1
+        if int(last) == 0:
+            start = size
+    # Valid, but nothing in the bundle to send
+    if start >= size:
+        raise HTTPException(status_code=416, detail="Range Not Satisfiable", headers={"Content-Range": f'bytes */{size}'})
+
+    return start, min(end, size - 1)
+
+def readChunk(file: BinaryIO, offset: int, length: int) -> bytes:
+    file.seek(offset)
+    return file.read(length)
+
+async def streamFile(file: BinaryIO, start: int, end: int) -> AsyncIterator[bytes]:
+    # ASGI can't hand the server a file descriptor, so the bundle goes through here in chunks either way.
+    # FileResponse does the same in 64KB reads, but it only opens the path once the handler has returned
+    try:
+        offset = start
+        while offset <= end:
+            chunk = await asyncio.to_thread(readChunk, file, offset, min(BUNDLE_CHUNK_SIZE, end + 1 - offset))
+            if not chunk:
+                break
+            offset += len(chunk)
+            yield chunk
+    finally:
+        file.close()
 
 async def getAssetBundle(bundleName: str,
                          version: int, 
                          forceReDownload: bool=False, 
-                         assetOS: AssetOS=AssetOS.WINDOWS
+                         assetOS: AssetOS=AssetOS.WINDOWS, 
+                         ifNoneMatch: Optional[str]=None,
+                         rangeHeader: Optional[str]=None,
+                         ifRange: Optional[str]=None,
+                         ifModifiedSince: Optional[str]=None
                          ) -> Response:
-    match assetOS:
-        case 1:
-            bundlePathFormat = 'tmp/bundles/android/{}{}'
-        case 2:
-            bundlePathFormat = 'tmp/bundles/ios/{}{}'
-        case _:
-            bundlePathFormat = 'tmp/bundles/windows/{}{}'
-    
-    match bundleName.split('_')[0]:
-            case 'audio':
-                assetExtension = '.wwpkg'
-            case _:
-                assetExtension = '.bundle'
+    assetExtension = getAssetExtension(bundleName)
+    record = await getRecord(bundleName, version, assetOS)
+    bundleVersion = getBundleVersion(record)
+    bundlePath = getBundlePath(bundleName, bundleVersion, assetOS)
+    # The ETag follows the bundle and not the assetVersion, so it stays valid across patches that didn't touch it
+    etag = f'"{assetOS.value}-{bundleVersion}-{bundleName}"'
 
-    bundlePath = bundlePathFormat.format(bundleName, assetExtension)
+    if ifNoneMatch is not None and not forceReDownload:
+        if ifNoneMatch.strip() == '*' or etag in [tag.strip().removeprefix('W/') for tag in ifNoneMatch.split(',')]:
+            return Response(status_code=304, headers={"ETag": etag})
 
-    if not os.path.isfile(bundlePath) or forceReDownload:
+    async def download():
         logger.debug(f'Downloading {bundleName}{assetExtension}')
         try:
-            await RequestManager.getSaveAsset(bundleName + assetExtension, version, bundlePath)
+            await RequestManager.getSaveAsset(bundleName + assetExtension, version, bundlePath, assetOS, record['crc'], record['size'])
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
-    
-    async with FileLock.claimFile(os.path.abspath(bundlePath)):
-        async with aiofiles.open(os.path.abspath(bundlePath), "rb") as file:
-            content = await file.read()
 
-    return Response(
-        content=content,
+    if forceReDownload or not await BundleCache.exists(bundlePath):
+        cacheRequests.inc('bundle', 'miss')
+        await download()
+    else:
+        cacheRequests.inc('bundle', 'hit')
+
+    # The file is opened before returning, so /cleanup or eviction removing it while it is sent can't break the response.
+    # Bundles are only ever replaced by a rename and the open file keeps pointing at the bundle that was opened
+    try:
+        file, stat = await asyncio.to_thread(openBundle, bundlePath)
+    except FileNotFoundError:
+        BundleCache.forget(bundlePath)
+        await download()
+        try:
+            file, stat = await asyncio.to_thread(openBundle, bundlePath)
+        except FileNotFoundError:
+            raise HTTPException(status_code=503, detail=f"{bundleName} was removed from the cache while sending it, try again")
+    BundleCache.touch(bundlePath)
+
+    size = stat.st_size
+    lastModified = formatdate(stat.st_mtime, usegmt=True)
+    # If-None-Match was already checked above and wins over If-Modified-Since when both are sent
+    if ifNoneMatch is None and not forceReDownload and notModifiedSince(ifModifiedSince, stat.st_mtime):
+        file.close()
+        return Response(status_code=304, headers={"ETag": etag, "Last-Modified": lastModified})
+
+    headers = {
+        "ETag": etag,
+        "Last-Modified": lastModified,
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f'attachment; filename="{bundleName}{assetExtension}"'
+    }
+    try:
+        byteRange = getRange(rangeHeader, ifRange, [etag, lastModified], size)
+    except HTTPException:
+        file.close()
+        raise
+    start, end = byteRange if byteRange is not None else (0, size - 1)
+    headers["Content-Length"] = str(end + 1 - start)
+    if byteRange is not None:
+        headers["Content-Range"] = f'bytes {start}-{end}/{size}'
+
+    return StreamingResponse(
+        streamFile(file, start, end),
+        status_code=206 if byteRange is not None else 200,
         media_type="application/octet-stream",
-        headers={
-            "Content-Disposition": f'attachment; filename="{bundleName}{assetExtension}"'
-        }
+        headers=headers
     )
\ No newline at end of file
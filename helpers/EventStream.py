@@ -0,0 +1,67 @@
+# Streams /Asset/many and /Asset/getDiff as newline delimited JSON or Server-Sent Events.
+# Every event has a type: start, asset, progress or end. Asset events hold the same entry as the JSON list.
+from helpers.TypeHelpers import BatchFormat, ImageFormat
+from helpers.Texture2DDecoder import toDataUris
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+import asyncio
+import json
+import os
+
+# Seconds without a finished asset before a progress event is sent anyway, so proxies don't drop an idle connection
+STREAM_HEARTBEAT = float(os.getenv('STREAM_HEARTBEAT', '15'))
+
+EVENT_TYPES = {
+    BatchFormat.NDJSON: 'application/x-ndjson',
+    BatchFormat.SSE: 'text/event-stream'
+}
+# Stops nginx and similar proxies from buffering the whole stream before passing it on
+EVENT_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def formatEvent(event: Dict[str, Any], batchFormat: BatchFormat) -> bytes:
+    data = json.dumps(event, separators=(',', ':'))
+    if batchFormat == BatchFormat.SSE:
+        return f'event: {event["type"]}\ndata: {data}\n\n'.encode()
+
+    return f'{data}\n'.encode()
+
+async def streamEvents(results: AsyncIterator[Tuple[int, Dict[str, Any]]],
+                       total: int,
+                       batchFormat: BatchFormat,
+                       imageFormat: ImageFormat=ImageFormat.PNG,
+                       heartbeat: float=STREAM_HEARTBEAT
+                       ) -> AsyncIterator[bytes]:
+    done = 0
+    failed = 0
+    yield formatEvent({"type": "start", "total": total}, batchFormat)
+
+    # The next result is awaited as a task and never cancelled by the heartbeat, cancelling it would close the generator
+    pending: Optional[asyncio.Task] = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(anext(results))
+            finished, _ = await asyncio.wait([pending], timeout=heartbeat if heartbeat > 0 else None)
+            if not finished:
+                yield formatEvent({"type": "progress", "done": done, "failed": failed, "total": total}, batchFormat)
+                continue
+
+            try:
+                index, result = pending.result()
+            except StopAsyncIteration:
+                pending = None
+                break
+            pending = None
+
+            done += 1
+            if "assetData" in result:
+                event = {"type": "asset", "index": index, "assetName": result["assetName"], "assetData": toDataUris(result["assetData"], imageFormat)}
+            else:
+                failed += 1
+                event = {"type": "asset", "index": index, **result}
+            yield formatEvent(event, batchFormat)
+            yield formatEvent({"type": "progress", "done": done, "failed": failed, "total": total}, batchFormat)
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+    yield formatEvent({"type": "end", "done": done, "failed": failed, "total": total}, batchFormat)
\ No newline at end of file
@@ -16,22 +16,26 @@ def getAllFilePaths(directory: str) -> List[str]:
     for dirpath, dirnames, filenames in os.walk(directory):
         for filename in filenames:
             filepath = os.path.join(dirpath, filename)
+            # Lock files are cleaned up by cleanFileLock, the ones in use by other workers have to stay
+            if FileLock.isLockFile(filepath):
+                continue
             filePaths.append(filepath)
     return filePaths
 
 async def delFile(file: str):
     try:
         logger.info(f'Deleting {file}')
-        if FileLock.checkFileInFileLock(file):
+        if await asyncio.to_thread(FileLock.checkFileInFileLock, file):
             async with FileLock.claimFile(file):
-                os.remove(file)
+                FileLock.discard(file)
+                await asyncio.to_thread(os.remove, file)
         else:
-            os.remove(file)
+            await asyncio.to_thread(os.remove, file)
     except Exception as e:
         logger.error(f'Error deleting file: {file}, {e}')
 
 async def cleanup(filepath: str):
-    fileList = getAllFilePaths(filepath)
+    fileList = await asyncio.to_thread(getAllFilePaths, filepath)
 
     try:
         tasks = [asyncio.create_task(delFile(file)) for file in fileList]
@@ -40,9 +44,9 @@ async def cleanup(filepath: str):
     except Exception as e:
         logger.error(f'Failed to clean directory: {filepath}, {e}')
     
-    if __name__ != '__main__':
-        FileLock.cleanFileLock()
-        logger.info('Cleaned FileLock KeyStore')
+    FileLock.cleanFileLock()
+    await asyncio.to_thread(FileLock.cleanLockFiles)
+    logger.info('Cleaned FileLock KeyStore')
 
 if __name__ == '__main__':
     asyncio.run(cleanup(os.path.abspath('./tmp')))
\ No newline at end of file
@@ -1,24 +1,235 @@
-from typing import Dict
+# Every cached file gets a lock file under FILE_LOCK_PATH, so uvicorn workers sharing tmp/ can't download, decode
+# and evict the same bundle at once. Coroutines of one process queue on an asyncio.Lock before touching the lock file.
+# The lock files sit on the same volume as the cache, which can be a network share, so they are only touched in threads.
+from typing import Dict, Optional
+import hashlib
 import asyncio
+import time
+import os
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no fcntl, lock files created with O_EXCL work everywhere
+    fcntl = None
+
+FILE_LOCK_PATH = os.getenv('FILE_LOCK_PATH', 'tmp/locks')
+FILE_LOCK_BACKEND = os.getenv('FILE_LOCK_BACKEND', 'fcntl' if fcntl is not None else 'lockfile').lower()
+# Lock files older than this are left over from a process that died while holding them (lockfile backend only)
+FILE_LOCK_STALE = float(os.getenv('FILE_LOCK_STALE', '600'))
+# Seconds between attempts while another process holds a lock, doubling up to the max
+LOCK_POLL_MIN = 0.005
+LOCK_POLL_MAX = 0.1
+
+class fcntl_backend:
+    threaded = True
+
+    def tryAcquire(self, lockPath: str) -> Optional[int]:
+        os.makedirs(os.path.dirname(lockPath), exist_ok=True)
+        fd = os.open(lockPath, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB) # type: ignore
+        except BlockingIOError:
+            os.close(fd)
+            return None
+
+        # The lock file can be removed and created again between the open and the flock, a lock on the old one guards nothing
+        try:
+            current = os.stat(lockPath).st_ino == os.fstat(fd).st_ino
+        except FileNotFoundError:
+            current = False
+        if not current:
+            os.close(fd)
+            return None
+
+        return fd
+
+    def release(self, handle: int, lockPath: str, remove: bool):
+        try:
+            # Removed while still held, whoever was waiting on the old file notices and tries again
+            if remove:
+                os.remove(lockPath)
+        except FileNotFoundError:
+            pass
+        finally:
+            os.close(handle)
+
+    def probe(self, lockPath: str) -> bool:
+        try:
+            fd = os.open(lockPath, os.O_RDWR)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB) # type: ignore
+            return False
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+
+class lockfile_backend:
+    threaded = True
+
+    def tryAcquire(self, lockPath: str) -> Optional[int]:
+        os.makedirs(os.path.dirname(lockPath), exist_ok=True)
+        try:
+            fd = os.open(lockPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            self.removeStale(lockPath)
+            return None
+
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        return 0
+
+    def release(self, handle: int, lockPath: str, remove: bool):
+        try:
+            os.remove(lockPath)
+        except FileNotFoundError:
+            pass
+
+    def probe(self, lockPath: str) -> bool:
+        try:
+            return time.time() - os.path.getmtime(lockPath) < FILE_LOCK_STALE
+        except FileNotFoundError:
+            return False
+
+    def removeStale(self, lockPath: str):
+        try:
+            if time.time() - os.path.getmtime(lockPath) >= FILE_LOCK_STALE:
+                os.remove(lockPath)
+        except FileNotFoundError:
+            pass
+
+class memory_backend:
+    # Only the asyncio.Lock, for a single process that doesn't want lock files
+    threaded = False
+
+    def tryAcquire(self, lockPath: str) -> Optional[int]:
+        return 0
+
+    def release(self, handle: int, lockPath: str, remove: bool):
+        pass
+
+    def probe(self, lockPath: str) -> bool:
+        return False
+
+BACKENDS = {
+    'fcntl': fcntl_backend,
+    'lockfile': lockfile_backend,
+    'memory': memory_backend
+}
+
+class file_lock:
+    def __init__(self, backend, lockPath: str):
+        self.backend = backend
+        self.lockPath = lockPath
+        self.lock = asyncio.Lock()
+        self.handle: Optional[int] = None
+        self.discard = False
+
+    def locked(self) -> bool:
+        return self.lock.locked()
+
+    async def tryAcquire(self) -> Optional[int]:
+        if not self.backend.threaded:
+            return self.backend.tryAcquire(self.lockPath)
+
+        attempt = asyncio.ensure_future(asyncio.to_thread(self.backend.tryAcquire, self.lockPath))
+        try:
+            return await asyncio.shield(attempt)
+        except asyncio.CancelledError:
+            # The thread can't be stopped, if it got the lock after all it is given back
+            handle = await attempt
+            if handle is not None:
+                await asyncio.to_thread(self.backend.release, handle, self.lockPath, False)
+            raise
+
+    async def acquire(self) -> bool:
+        await self.lock.acquire()
+        try:
+            delay = LOCK_POLL_MIN
+            while (handle := await self.tryAcquire()) is None:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, LOCK_POLL_MAX)
+            self.handle = handle
+        except BaseException:
+            self.lock.release()
+            raise
+
+        return True
+
+    async def release(self):
+        try:
+            if self.handle is not None:
+                if self.backend.threaded:
+                    # Shielded so a cancelled holder still gives the lock back to the other processes
+                    await asyncio.shield(asyncio.to_thread(self.backend.release, self.handle, self.lockPath, self.discard))
+                else:
+                    self.backend.release(self.handle, self.lockPath, self.discard)
+        finally:
+            self.handle = None
+            self.discard = False
+            self.lock.release()
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *args):
+        await self.release()
 
 class FileLock:
-    def __init__(self):
-        self.KeyStore: Dict[str, asyncio.Lock] = {}
-    
-    def claimFile(self, filepath: str) -> asyncio.Lock:
+    def __init__(self, directory: str=FILE_LOCK_PATH, backend: str=FILE_LOCK_BACKEND):
+        if backend == 'fcntl' and fcntl is None:
+            backend = 'lockfile'
+        self.directory = os.path.abspath(directory)
+        self.backend = BACKENDS[backend]()
+        self.KeyStore: Dict[str, file_lock] = {}
+
+    def getLockPath(self, filepath: str) -> str:
+        digest = hashlib.sha1(os.path.abspath(filepath).encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], f'{digest}.lock')
+
+    def claimFile(self, filepath: str) -> file_lock:
         if not filepath in self.KeyStore:
-            self.KeyStore[filepath] = asyncio.Lock()
-            
+            self.KeyStore[filepath] = file_lock(self.backend, self.getLockPath(filepath))
+
         return self.KeyStore[filepath]
-    
+
     def checkFileInFileLock(self, filepath: str) -> bool:
         if filepath in self.KeyStore:
             return True
-        return False
-    
+        # Another process may be using it. Checks the lock directory, run it in a thread
+        return os.path.exists(self.getLockPath(filepath))
+
+    def isLocked(self, filepath: str) -> bool:
+        # Probes the lock file, run it in a thread
+        lock = self.KeyStore.get(filepath)
+        if lock is not None and lock.locked():
+            return True
+        return self.backend.probe(self.getLockPath(filepath))
+
+    def discard(self, filepath: str):
+        # Call while holding the lock of a file that is being deleted, its lock file goes with it on release
+        lock = self.KeyStore.get(filepath)
+        if lock is not None and lock.locked():
+            lock.discard = True
+
+    def isLockFile(self, filepath: str) -> bool:
+        return os.path.abspath(filepath).startswith(self.directory + os.sep)
+
     def cleanFileLock(self):
         for key in list(self.KeyStore.keys()):
             if not self.KeyStore[key].locked():
                 del self.KeyStore[key]
 
+    def cleanLockFiles(self):
+        # Lock files nobody holds can go, ones in use by any process stay. Walks the lock directory, run it in a thread
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                lockPath = os.path.join(dirpath, filename)
+                handle = self.backend.tryAcquire(lockPath)
+                if handle is not None:
+                    self.backend.release(handle, lockPath, True)
+
 GlobalFileLock = FileLock()
\ No newline at end of file
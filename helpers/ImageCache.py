@@ -0,0 +1,110 @@
+from helpers.CacheIndex import cache_index, CACHE_INDEX_INTERVAL
+from helpers.Metrics import Metrics, cacheRequests
+from typing import Any, Optional, Tuple
+import asyncio
+import hashlib
+import json
+import uuid
+import os
+
+IMAGE_CACHE_PATH = os.getenv('IMAGE_CACHE_PATH', 'tmp/decoded')
+IMAGE_CACHE_SIZE_MB = int(os.getenv('IMAGE_CACHE_SIZE_MB', '1024'))
+
+class image_cache(cache_index):
+    def __init__(self, directory: str=IMAGE_CACHE_PATH, maxSize: int=IMAGE_CACHE_SIZE_MB * 1024 * 1024):
+        # Keyed by digest, which is also the file name. Eviction happens as images are put, the loop only saves the index
+        super().__init__('imageCache', 'decoded images', [directory], maxSize, CACHE_INDEX_INTERVAL)
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def getDigest(self, key: Tuple[Any, ...]) -> str:
+        return hashlib.sha256(json.dumps(key, separators=(',', ':')).encode()).hexdigest()
+
+    def getPath(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest)
+
+    async def get(self, key: Tuple[Any, ...]) -> Optional[bytes]:
+        digest = self.getDigest(key)
+        path = self.getPath(digest)
+
+        try:
+            data = await asyncio.to_thread(readFile, path)
+        except FileNotFoundError:
+            self.forget(digest)
+            self.misses += 1
+            cacheRequests.inc('image', 'miss')
+            return None
+
+        # Written by another worker, or asked for before the startup scan got to it
+        if digest not in self.index:
+            self.add(digest, len(data))
+        self.index.move_to_end(digest)
+        self.unconfirmed.discard(digest)
+        self.changes += 1
+        self.hits += 1
+        cacheRequests.inc('image', 'hit')
+
+        return data
+
+    async def put(self, key: Tuple[Any, ...], data: bytes):
+        digest = self.getDigest(key)
+        path = self.getPath(digest)
+
+        try:
+            await asyncio.to_thread(writeFile, path, data)
+        except Exception as e:
+            # The cache is only an optimisation, failing to fill it shouldn't fail the request
+            self.logger.warning(f'Failed to cache {key}: {e}')
+            return
+
+        self.forget(digest)
+        self.add(digest, len(data))
+        await self.evict()
+
+    def getKey(self, path: str) -> str:
+        return os.path.basename(path)
+
+    def add(self, digest: str, size: int):
+        self.index[digest] = size
+        self.size += size
+        self.unconfirmed.discard(digest)
+        self.changes += 1
+
+    async def evict(self):
+        evicted = []
+        while self.size > self.maxSize and self.index:
+            digest, size = self.index.popitem(last=False)
+            self.size -= size
+            self.changes += 1
+            evicted.append(self.getPath(digest))
+
+        if evicted:
+            self.logger.debug(f'Evicting {len(evicted)} decoded images')
+            await asyncio.to_thread(self.removeFiles, evicted)
+
+    def removeFiles(self, paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def readFile(path: str) -> bytes:
+    with open(path, 'rb') as file:
+        return file.read()
+
+def writeFile(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written next to the real file and renamed into place so readers never see half an image
+    tempPath = f'{path}.{uuid.uuid4().hex}.part'
+    try:
+        with open(tempPath, 'wb') as file:
+            file.write(data)
+        os.replace(tempPath, path)
+    finally:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+
+ImageCache = image_cache()
+Metrics.gauge('assetapi_image_cache_bytes', 'Size of the decoded image cache on disk', lambda: ImageCache.size)
\ No newline at end of file
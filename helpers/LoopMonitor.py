@@ -0,0 +1,53 @@
+from helpers import Logger
+from helpers.Metrics import Metrics
+from typing import Optional
+import asyncio
+import os
+
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.5'))
+LOOP_LAG_WARN_MS = float(os.getenv('LOOP_LAG_WARN_MS', '100'))
+# asyncio's debug mode names the callback that blocked the loop, but it slows everything else down
+LOOP_DEBUG = os.getenv('LOOP_DEBUG', 'False').lower() == 'true'
+
+LAG_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+
+loopLag = Metrics.histogram('assetapi_event_loop_lag_seconds', 'How much later than planned the event loop woke up a sleeping task', LAG_BUCKETS)
+
+class loop_monitor:
+    def __init__(self, interval: float=LOOP_LAG_INTERVAL, warnMs: float=LOOP_LAG_WARN_MS, debug: bool=LOOP_DEBUG):
+        self.logger = Logger.getLogger('loopMonitor')
+        self.interval = interval
+        self.warn = warnMs / 1000
+        self.debug = debug
+        self.maxLag = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            # Anything past the planned wakeup was spent running callbacks that didn't yield
+            lag = max(0.0, loop.time() - started - self.interval)
+            loopLag.observe(lag)
+            self.maxLag = max(self.maxLag, lag)
+            if lag >= self.warn:
+                self.logger.warning(f'Event loop was blocked for {lag * 1000:.0f}ms')
+
+    def start(self):
+        if self.debug:
+            # Slow callbacks are logged by the asyncio logger with the callback that ran
+            loop = asyncio.get_running_loop()
+            loop.set_debug(True)
+            loop.slow_callback_duration = self.warn
+        if self.interval > 0 and self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+LoopMonitor = loop_monitor()
+Metrics.gauge('assetapi_event_loop_max_lag_seconds', 'Longest the event loop was blocked since startup', lambda: LoopMonitor.maxLag)
\ No newline at end of file
@@ -1,57 +1,241 @@
-from helpers import ManifestDecoderHelper, Logger
+from helpers import ManifestDecoderHelper, ManifestStore, Logger
 from helpers.RequestManager import RequestManager
-from helpers.FileLock import GlobalFileLock as FileLock
-from helpers.TypeHelpers import AssetOS
-from typing import Dict, List, Any
-import aiofiles
+from helpers.Metrics import Metrics, cacheRequests
+from helpers.BundleCache import BundleCache
+from helpers.SingleFlight import single_flight
+from helpers.TypeHelpers import AssetOS, DependencyMode
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Any, Optional, Set, Tuple
 import asyncio
-import json
+import time
 import os
 
 logger = Logger.getLogger("getManifest")
 
-def decodeManifest(manifest: bytes) -> List[Dict[str, Any]]:
+parseSeconds = Metrics.histogram('assetapi_manifest_parse_seconds', 'Time taken to turn a manifest into records', labels=['source'])
+
+MANIFEST_CACHE_MB = int(os.getenv('MANIFEST_CACHE_MB', '256'))
+# Rough size of one record dict plus its share of the indexes, only used to keep the cache inside its budget
+RECORD_OVERHEAD = 1000
+DEPENDENCY_OVERHEAD = 100
+ENTRY_OVERHEAD = 400
+
+class ParsedManifest:
+    def __init__(self, records: List[Dict[str, Any]]):
+        self.records = records
+        self.names = [record['name'] for record in records]
+        self.byName: Dict[str, Dict[str, Any]] = {}
+        self.byPrefix: Dict[str, List[Dict[str, Any]]] = {}
+        # dependency name -> names of the bundles that depend on it
+        self.dependents: Dict[str, List[str]] = {}
+        self.size = 0
+        for record in records:
+            self.byName.setdefault(record['name'], record)
+            self.byPrefix.setdefault(record['prefix'], []).append(record)
+            for dependency in record['dependencies']:
+                self.dependents.setdefault(dependency, []).append(record['name'])
+            self.size += RECORD_OVERHEAD + len(record['name']) + DEPENDENCY_OVERHEAD * len(record['dependencies']) + ENTRY_OVERHEAD * len(record['entries'])
+
+    def getRecords(self, prefix: Optional[str]=None) -> List[Dict[str, Any]]:
+        if prefix is None:
+            return self.records
+
+        return self.byPrefix.get(prefix, [])
+
+    def getLinked(self, name: str, mode: DependencyMode) -> List[str]:
+        match mode:
+            case 1:
+                record = self.byName.get(name)
+                return record['dependencies'] if record is not None else []
+            case 2:
+                return self.dependents.get(name, [])
+            case _:
+                return []
+
+    def expandNames(self, names: List[str], mode: DependencyMode) -> List[str]:
+        # Breadth first walk of the dependency graph. The names passed in keep their order and come first,
+        # names the manifest doesn't have a record for are left out
+        response = list(names)
+        seen = set(names)
+        queue = deque(names)
+        while queue:
+            for linked in self.getLinked(queue.popleft(), mode):
+                if linked not in seen and linked in self.byName:
+                    seen.add(linked)
+                    response.append(linked)
+                    queue.append(linked)
+
+        return response
+
+    def getDownloadSize(self, names: List[str]) -> int:
+        return sum(self.byName[name]['size'] for name in names if name in self.byName)
+
+class manifest_cache:
+    def __init__(self, maxSize: int=MANIFEST_CACHE_MB * 1024 * 1024):
+        self.maxSize = maxSize
+        self.entries: OrderedDict[Tuple[int, int], ParsedManifest] = OrderedDict()
+        self.size = 0
+
+    def get(self, version: int, assetOS: AssetOS) -> Optional[ParsedManifest]:
+        key = (int(assetOS), version)
+        manifest = self.entries.get(key)
+        if manifest is not None:
+            self.entries.move_to_end(key)
+            cacheRequests.inc('manifest', 'hit')
+        else:
+            cacheRequests.inc('manifest', 'miss')
+
+        return manifest
+
+    def put(self, version: int, assetOS: AssetOS, manifest: ParsedManifest):
+        self.invalidate(version, assetOS)
+        self.entries[(int(assetOS), version)] = manifest
+        self.size += manifest.size
+
+        # Always keep the newest entry, even if it is bigger than the budget on its own
+        while self.size > self.maxSize and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+
+    def invalidate(self, version: int, assetOS: AssetOS):
+        manifest = self.entries.pop((int(assetOS), version), None)
+        if manifest is not None:
+            self.size -= manifest.size
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+ManifestCache = manifest_cache()
+Metrics.gauge('assetapi_manifest_cache_bytes', 'Estimated memory used by parsed manifests', lambda: ManifestCache.size)
+manifestLoads = single_flight()
+saveTasks: Set[asyncio.Task] = set()
+Metrics.gauge('assetapi_manifest_loads_in_flight', 'Manifests being downloaded or read from disk', lambda: len(manifestLoads))
+
+def getManifestPath(version: int, assetOS: AssetOS) -> str:
+    return f'tmp/manifest/manifest_{int(assetOS)}_{version}.db'
+
+def getStoredVersions(assetOS: AssetOS) -> List[int]:
+    versions: List[int] = []
+    if os.path.isdir('tmp/manifest'):
+        for filename in os.listdir('tmp/manifest'):
+            parts = filename.removesuffix('.db').split('_')
+            if filename.endswith('.db') and len(parts) == 3 and parts[1] == str(int(assetOS)) and parts[2].isdigit():
+                versions.append(int(parts[2]))
+
+    return sorted(versions)
+
+def parseManifest(manifest: bytes) -> Any:
     manifestWorker = ManifestDecoderHelper.RawAssetManifest() # type: ignore
     manifestWorker.ParseFromString(manifest)
 
-    response: List[Dict[str, Any]] = []
-    for record in manifestWorker.records:
-        prefixList = record.name.split('_')
-        if len(prefixList) >= 2:
-            prefix = prefixList[0]
-        else:
-            prefix = "NOPREFIX"
-        response.append({"name": record.name, "version": record.version, "prefix": prefix})
-        
-    return response
+    return manifestWorker
+
+def getRecords(manifestWorker: Any) -> List[Dict[str, Any]]:
+    return [ManifestStore.recordToDict(record) for record in manifestWorker.records]
+
+def decodeManifest(manifest: bytes) -> List[Dict[str, Any]]:
+    return getRecords(parseManifest(manifest))
 
-async def saveManifest(version: int, assetOS: AssetOS, decoded_manifest: List[Dict[str, Any]]):
+def readStoredManifest(path: str) -> List[Dict[str, Any]]:
+    raw = ManifestStore.readRaw(path)
+    if raw is None:
+        return ManifestStore.readRecords(path)
+
+    return decodeManifest(raw)
+
+async def saveManifest(version: int, assetOS: AssetOS, manifest: Any, raw: bytes):
     try:
-        os.makedirs('tmp/manifest', exist_ok=True)
-        async with FileLock.claimFile(os.path.abspath(f'tmp/manifest/manifest_{assetOS}_{version}.json')):
-            async with aiofiles.open(f'tmp/manifest/manifest_{assetOS}_{version}.json', 'w') as file:
-                json_str = json.dumps(decoded_manifest, indent=4)
-                await file.write(json_str)
+        path = getManifestPath(version, assetOS)
+        await asyncio.to_thread(ManifestStore.writeManifest, path, manifest, raw)
+        BundleCache.touch(path, await asyncio.to_thread(os.path.getsize, path))
     except Exception as e:
         logger.error(f'Error in saveManifest: {e}')
         raise e
 
-async def getAssetManifest(version: int, assetOS: AssetOS=AssetOS.WINDOWS) -> List[str]:
-    decoded_manifest = decodeManifest(await RequestManager.getAsset("manifest.data", version, assetOS, "content")) # type: ignore
-    asyncio.create_task(saveManifest(version, assetOS, decoded_manifest))
+async def downloadManifest(version: int, assetOS: AssetOS) -> ParsedManifest:
+    raw = await RequestManager.getAsset("manifest.data", version, assetOS, "content")
+    started = time.perf_counter()
+    manifest = await asyncio.to_thread(parseManifest, raw)
+    parsed = ParsedManifest(await asyncio.to_thread(getRecords, manifest))
+    parseSeconds.observe(time.perf_counter() - started, 'cdn')
+    ManifestCache.put(version, assetOS, parsed)
+
+    # Everything is served from memory now, so the store can be written in the background
+    task = asyncio.create_task(saveManifest(version, assetOS, manifest, raw))
+    saveTasks.add(task)
+    task.add_done_callback(saveTasks.discard)
+
+    return parsed
+
+async def loadManifest(version: int, assetOS: AssetOS, forceReDownload: bool) -> ParsedManifest:
+    path = getManifestPath(version, assetOS)
+    if forceReDownload or not await BundleCache.exists(path):
+        logger.debug("Couldn't find manifest or user requested a new one")
+        return await downloadManifest(version, assetOS)
+
+    started = time.perf_counter()
+    try:
+        parsed = ParsedManifest(await asyncio.to_thread(readStoredManifest, path))
+    except FileNotFoundError:
+        # Evicted by another worker or /cleanup since it was indexed
+        BundleCache.forget(path)
+        return await downloadManifest(version, assetOS)
+    parseSeconds.observe(time.perf_counter() - started, 'store')
+    BundleCache.touch(path)
+    ManifestCache.put(version, assetOS, parsed)
+
+    return parsed
+
+async def loadShared(version: int, assetOS: AssetOS, forceReDownload: bool) -> ParsedManifest:
+    # Concurrent misses for the same manifest share one load
+    key = (int(assetOS), version, forceReDownload)
+    return await manifestLoads.run(key, lambda: loadManifest(version, assetOS, forceReDownload))
+
+async def getManifest(version: int, assetOS: AssetOS=AssetOS.WINDOWS, forceReDownload: bool=False) -> ParsedManifest:
+    if forceReDownload:
+        ManifestCache.invalidate(version, assetOS)
+    else:
+        cached = ManifestCache.get(version, assetOS)
+        if cached is not None:
+            return cached
+
+    return await loadShared(version, assetOS, forceReDownload)
+
+async def readStore(version: int, assetOS: AssetOS, reader: Callable[..., Any], *args: Any) -> Tuple[bool, Any]:
+    # (False, None) if there is no stored manifest to read from
+    path = getManifestPath(version, assetOS)
+    if not await BundleCache.exists(path):
+        return False, None
+    try:
+        result = await asyncio.to_thread(reader, path, *args)
+    except FileNotFoundError:
+        BundleCache.forget(path)
+        return False, None
+    BundleCache.touch(path)
+
+    return True, result
+
+async def getRecord(name: str, version: int, assetOS: AssetOS=AssetOS.WINDOWS) -> Optional[Dict[str, Any]]:
+    # A manifest that isn't in memory is looked up in its store by name, instead of loading every record to find one
+    cached = ManifestCache.get(version, assetOS)
+    if cached is not None:
+        return cached.byName.get(name)
 
-    response = []
-    for object in decoded_manifest:
-        response.append(object["name"])
+    found, record = await readStore(version, assetOS, ManifestStore.readRecord, name)
+    if found:
+        return record
 
-    return response
+    return (await loadShared(version, assetOS, False)).byName.get(name)
 
-async def getAssetManifestBlocking(version: int, assetOS: AssetOS=AssetOS.WINDOWS) -> List[str]:
-    decoded_manifest = decodeManifest(await RequestManager.getAsset("manifest.data", version, assetOS, "content")) # type: ignore
-    await saveManifest(version, assetOS, decoded_manifest)
+async def getPrefixManifest(version: int, assetOS: AssetOS, prefix: str) -> ParsedManifest:
+    # Only holds the records with this prefix when read from the store, so it isn't put in ManifestCache
+    cached = ManifestCache.get(version, assetOS)
+    if cached is not None:
+        return cached
 
-    response = []
-    for object in decoded_manifest:
-        response.append(object["name"])
+    found, records = await readStore(version, assetOS, ManifestStore.readRecords, prefix)
+    if found:
+        return ParsedManifest(records)
 
-    return response
\ No newline at end of file
+    return await loadShared(version, assetOS, False)
\ No newline at end of file
@@ -1,70 +1,65 @@
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
 from helpers.TypeHelpers import DiffVersion
+from helpers.Metrics import Metrics
+import time
 
-def compareManifest(newManifestFull: List[Dict[str, Any]], 
-                    oldManifestFull: List[Dict[str, Any]], 
-                    type: DiffVersion=DiffVersion.ALL, 
-                    prefix: str='None'
-                    ) -> List[str]:
-    
-    newManifest: List[Dict[str, Any]] = []
-    oldManifest: List[Dict[str, Any]] = []
+diffSeconds = Metrics.histogram('assetapi_manifest_diff_seconds', 'Time taken to diff two manifests')
 
-    if prefix != 'None':
-        for key in range(len(oldManifestFull)):
-            if oldManifestFull[key]['prefix'] == prefix:
-                oldManifest.append(oldManifestFull[key])
-        for key in range(len(newManifestFull)):
-            if newManifestFull[key]['prefix'] == prefix:
-                newManifest.append(newManifestFull[key])
-    else:
-        newManifest = newManifestFull
-        oldManifest = oldManifestFull
+def compareManifest(newManifest: List[Dict[str, Any]],
+                    oldManifest: List[Dict[str, Any]],
+                    type: DiffVersion=DiffVersion.ALL,
+                    skipUnchanged: bool=False
+                    ) -> List[str]:
+    # Callers pass the records of one prefix already, ParsedManifest.getRecords has them grouped
+    changes = diffManifest(newManifest, oldManifest, skipUnchanged)
 
     match type:
         case 1:
-            return checkForNew(newManifest, oldManifest)
+            return [change['name'] for change in changes['added']]
         case 2:
-            return checkForChange(newManifest, oldManifest)
+            return [change['name'] for change in changes['changed']]
         case _:
-            return checkForNew(newManifest, oldManifest) + checkForChange(newManifest, oldManifest)
+            return [change['name'] for change in changes['added'] + changes['changed']]
 
-def checkForNew(newManifest: List[Dict[str, Any]], 
-                oldManifest: List[Dict[str, Any]]
-                ) -> List[str]:
-    oldNames = []
-    for object in oldManifest:
-        oldNames.append(object['name'])
+def getChange(newRecord: Optional[Dict[str, Any]], oldRecord: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    newRecord = newRecord or {}
+    oldRecord = oldRecord or {}
 
-    response: List[str] = []
-    for key in range(len(newManifest)):
-        if not newManifest[key]['name'] in oldNames:
-            response.append(newManifest[key]['name'])
+    return {
+        "name": newRecord.get('name', oldRecord.get('name')),
+        "oldVersion": oldRecord.get('version'),
+        "newVersion": newRecord.get('version'),
+        "oldSize": oldRecord.get('size'),
+        "newSize": newRecord.get('size'),
+        "oldCrc": oldRecord.get('crc'),
+        "newCrc": newRecord.get('crc')
+    }
 
-    return response
+def diffManifest(newManifest: List[Dict[str, Any]],
+                 oldManifest: List[Dict[str, Any]],
+                 skipUnchanged: bool=False
+                 ) -> Dict[str, List[Dict[str, Any]]]:
+    started = time.perf_counter()
+    # One pass over each manifest. If a name shows up twice, the first record wins, same as the old list scan did
+    oldRecords: Dict[str, Dict[str, Any]] = {}
+    for record in oldManifest:
+        oldRecords.setdefault(record['name'], record)
 
-def checkForChange(newManifest: List[Dict[str, Any]], 
-                   oldManifest: List[Dict[str, Any]]
-                   ) -> List[str]:
-    oldVersions = []
-    for object in oldManifest:
-        oldVersions.append({"name": object['name'], "version": object["version"]})
-    
-    oldNames = []
-    for object in oldManifest:
-        oldNames.append(object['name'])
+    added: List[Dict[str, Any]] = []
+    changed: List[Dict[str, Any]] = []
+    newNames = set()
+    for record in newManifest:
+        newNames.add(record['name'])
+        oldRecord = oldRecords.get(record['name'])
+        if oldRecord is None:
+            added.append(getChange(record, None))
+        elif record['version'] != oldRecord['version']:
+            # A version bump without a new size or crc is the same bundle republished
+            if skipUnchanged and record['size'] == oldRecord['size'] and record['crc'] == oldRecord['crc']:
+                continue
+            changed.append(getChange(record, oldRecord))
 
-    response: List[str] = []
-    for key in range(len(newManifest)):
-        if newManifest[key]['name'] in oldNames:
-            version = 'Null'
-            for object in oldVersions:
-                if object["name"] == newManifest[key]['name']:
-                    version = object["version"]
-                    break
-            if version == 'Null':
-                raise KeyError('Could not find object["name"] in checkForChange()')
-            if newManifest[key]['version'] != version:
-                response.append(newManifest[key]['name'])
+    removed = [getChange(None, record) for name, record in oldRecords.items() if name not in newNames]
+    diffSeconds.observe(time.perf_counter() - started)
 
-    return response
\ No newline at end of file
+    return {"added": added, "changed": changed, "removed": removed}
\ No newline at end of file
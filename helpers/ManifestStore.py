@@ -0,0 +1,133 @@
+# Manifests are stored as small SQLite databases, one per (assetOS, version).
+# Opening one is constant time and the indexes on name and prefix let a lookup read only the rows it needs.
+# The raw manifest is kept next to the rows, parsing it is the fastest way to load every record at once.
+# Everything in here is blocking, call it through asyncio.to_thread from the event loop.
+from typing import Any, Dict, List, Optional, Sequence
+from contextlib import closing
+import sqlite3
+import json
+import uuid
+import os
+
+SCHEMA = '''
+CREATE TABLE manifest (data BLOB NOT NULL);
+CREATE TABLE records (
+    name TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    prefix TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    uncompressed_size INTEGER NOT NULL,
+    shared INTEGER NOT NULL,
+    rank INTEGER NOT NULL,
+    packageType INTEGER NOT NULL,
+    crc INTEGER NOT NULL,
+    dependencies TEXT NOT NULL,
+    entries TEXT NOT NULL
+);
+CREATE INDEX records_name ON records (name);
+CREATE INDEX records_prefix ON records (prefix);
+'''
+
+ALL_COLUMNS = ['name', 'version', 'prefix', 'size', 'uncompressed_size', 'shared', 'rank', 'packageType', 'crc', 'dependencies', 'entries']
+JSON_COLUMNS = ['dependencies', 'entries']
+
+def getPrefix(name: str) -> str:
+    prefixList = name.split('_')
+    if len(prefixList) >= 2:
+        return prefixList[0]
+
+    return "NOPREFIX"
+
+def getEntries(record: Any) -> List[Dict[str, Any]]:
+    return [{"asset_name": entry.asset_name,
+             "runtime_size": entry.runtime_size,
+             "clone_runtime_size": entry.clone_runtime_size} for entry in record.entries]
+
+def recordToDict(record: Any) -> Dict[str, Any]:
+    return {
+        "name": record.name,
+        "version": record.version,
+        "prefix": getPrefix(record.name),
+        "size": record.size,
+        "uncompressed_size": record.uncompressed_size,
+        "shared": record.shared,
+        "rank": record.rank,
+        "packageType": record.packageType,
+        "crc": record.crc,
+        "dependencies": list(record.dependencies),
+        "entries": getEntries(record)
+    }
+
+def connect(path: str) -> sqlite3.Connection:
+    if not os.path.isfile(path):
+        raise FileNotFoundError(path)
+
+    return sqlite3.connect(f'file:{os.path.abspath(path)}?mode=ro', uri=True)
+
+def writeManifest(path: str, manifest: Any, raw: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Build the database next to the real one and rename it into place so readers never see a half written store
+    tempPath = f'{path}.{uuid.uuid4().hex}.part'
+    try:
+        connection = sqlite3.connect(tempPath)
+        try:
+            connection.executescript(SCHEMA)
+            connection.execute('INSERT INTO manifest VALUES (?)', (raw,))
+            connection.executemany('INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                (record.name,
+                 record.version,
+                 getPrefix(record.name),
+                 record.size,
+                 record.uncompressed_size,
+                 record.shared,
+                 record.rank,
+                 record.packageType,
+                 record.crc,
+                 json.dumps(list(record.dependencies)),
+                 json.dumps(getEntries(record)))
+                for record in manifest.records))
+            connection.commit()
+        finally:
+            connection.close()
+        os.replace(tempPath, path)
+    finally:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+
+def toDict(columns: Sequence[str], row: Sequence[Any]) -> Dict[str, Any]:
+    record = dict(zip(columns, row))
+    for column in JSON_COLUMNS:
+        if column in record:
+            record[column] = json.loads(record[column])
+    if 'shared' in record:
+        record['shared'] = bool(record['shared'])
+
+    return record
+
+def readRaw(path: str) -> Optional[bytes]:
+    with closing(connect(path)) as connection:
+        try:
+            row = connection.execute('SELECT data FROM manifest LIMIT 1').fetchone()
+        except sqlite3.OperationalError:
+            # Written before the raw manifest was kept
+            return None
+
+    return row[0] if row is not None else None
+
+def readRecords(path: str, prefix: Optional[str]=None, columns: Sequence[str]=ALL_COLUMNS) -> List[Dict[str, Any]]:
+    query = f'SELECT {", ".join(columns)} FROM records'
+    params: List[Any] = []
+    if prefix is not None:
+        query += ' WHERE prefix = ?'
+        params.append(prefix)
+    query += ' ORDER BY rowid'
+
+    with closing(connect(path)) as connection:
+        return [toDict(columns, row) for row in connection.execute(query, params)]
+
+def readRecord(path: str, name: str, columns: Sequence[str]=ALL_COLUMNS) -> Optional[Dict[str, Any]]:
+    # The first record wins if a name shows up twice, same as ParsedManifest.byName
+    with closing(connect(path)) as connection:
+        row = connection.execute(f'SELECT {", ".join(columns)} FROM records WHERE name = ? ORDER BY rowid LIMIT 1', (name,)).fetchone()
+
+    return toDict(columns, row) if row is not None else None
\ No newline at end of file
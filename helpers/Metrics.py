@@ -0,0 +1,147 @@
+# A small Prometheus text format registry, served at /metrics.
+# Metrics are registered once at import time by the module that owns them, registering a name twice returns the first one.
+from typing import Any, Callable, Dict, List, Sequence, Tuple, Union
+import bisect
+import math
+
+TIME_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+SIZE_BUCKETS = [1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2, 256 * 1024 ** 2]
+
+LabelValues = Tuple[str, ...]
+
+def formatLabels(names: Sequence[str], values: Sequence[Any]) -> str:
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{escaped}"')
+
+    return '{' + ','.join(pairs) + '}'
+
+def formatValue(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if float(value).is_integer():
+        return str(int(value))
+
+    return repr(float(value))
+
+class counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str]=()):
+        self.name = name
+        self.help = help
+        self.labels = list(labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labelValues: Any, amount: float=1):
+        key = tuple(str(value) for value in labelValues)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, *labelValues: Any) -> float:
+        return self.values.get(tuple(str(value) for value in labelValues), 0)
+
+    def render(self) -> List[str]:
+        return [f'{self.name}{formatLabels(self.labels, key)} {formatValue(value)}' for key, value in self.values.items()]
+
+class gauge:
+    kind = 'gauge'
+
+    # The value is read when /metrics is scraped. With labels the callback returns {labelValues: value}
+    def __init__(self, name: str, help: str, callback: Callable[[], Union[float, Dict[LabelValues, float]]], labels: Sequence[str]=()):
+        self.name = name
+        self.help = help
+        self.labels = list(labels)
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        value = self.callback()
+        if not self.labels:
+            return [f'{self.name} {formatValue(value)}'] # type: ignore
+
+        return [f'{self.name}{formatLabels(self.labels, key)} {formatValue(labelValue)}' for key, labelValue in value.items()] # type: ignore
+
+class histogram:
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float]=TIME_BUCKETS, labels: Sequence[str]=()):
+        self.name = name
+        self.help = help
+        self.labels = list(labels)
+        self.buckets = sorted(buckets)
+        # labelValues -> (count per bucket, sum, count)
+        self.values: Dict[LabelValues, List[Any]] = {}
+
+    def observe(self, value: float, *labelValues: Any):
+        key = tuple(str(labelValue) for labelValue in labelValues)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = [[0] * len(self.buckets), 0.0, 0]
+            self.values[key] = entry
+
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            entry[0][index] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucketCount in zip(self.buckets, counts):
+                cumulative += bucketCount
+                lines.append(f'{self.name}_bucket{formatLabels(self.labels + ["le"], key + (formatValue(bound),))} {cumulative}')
+            lines.append(f'{self.name}_bucket{formatLabels(self.labels + ["le"], key + ("+Inf",))} {count}')
+            lines.append(f'{self.name}_sum{formatLabels(self.labels, key)} {formatValue(total)}')
+            lines.append(f'{self.name}_count{formatLabels(self.labels, key)} {count}')
+
+        return lines
+
+class metrics_registry:
+    def __init__(self):
+        self.metrics: Dict[str, Union[counter, gauge, histogram]] = {}
+
+    def register(self, metric: Any) -> Any:
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labels: Sequence[str]=()) -> counter:
+        return self.register(counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, callback: Callable[[], Union[float, Dict[LabelValues, float]]], labels: Sequence[str]=()) -> gauge:
+        return self.register(gauge(name, help, callback, labels))
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float]=TIME_BUCKETS, labels: Sequence[str]=()) -> histogram:
+        return self.register(histogram(name, help, buckets, labels))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            try:
+                samples = metric.render()
+            except Exception as e:
+                # One broken callback shouldn't take the whole scrape down
+                lines.append(f'# {metric.name} failed: {e}')
+                continue
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(samples)
+
+        return '\n'.join(lines) + '\n'
+
+Metrics = metrics_registry()
+
+cacheRequests = Metrics.counter('assetapi_cache_requests_total', 'Cache lookups by cache and result', ['cache', 'result'])
+
+def getHitRatios() -> Dict[LabelValues, float]:
+    ratios: Dict[LabelValues, float] = {}
+    for cache in {key[0] for key in cacheRequests.values}:
+        hits = cacheRequests.get(cache, 'hit')
+        total = hits + cacheRequests.get(cache, 'miss')
+        ratios[(cache,)] = hits / total if total else 0
+
+    return ratios
+
+Metrics.gauge('assetapi_cache_hit_ratio', 'Share of cache lookups that were hits', getHitRatios, ['cache'])
\ No newline at end of file
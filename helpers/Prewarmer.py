@@ -0,0 +1,134 @@
+from helpers import ManifestDecoder, ManifestDiff, Texture2DDecoder, Logger
+from helpers.RequestManager import RequestManager
+from helpers.BundleCache import BundleCache
+from helpers.DecodeEngine import DecodeEngine
+from helpers.BundlePaths import getAssetExtension, getBundlePath, getBundleVersion
+from helpers.DownloadScheduler import PREWARM_CONCURRENCY
+from helpers.TypeHelpers import AssetOS, DiffVersion, Priority
+from typing import Any, Dict, List, Optional
+import asyncio
+import time
+import os
+
+PREWARM = os.getenv('PREWARM', 'False').lower() == 'true'
+PREWARM_OS = [AssetOS(int(assetOS)) for assetOS in os.getenv('PREWARM_OS', '0').split(',') if assetOS.strip()]
+PREWARM_PREFIXES = [prefix.strip() for prefix in os.getenv('PREWARM_PREFIXES', '').split(',') if prefix.strip()]
+PREWARM_DECODE = os.getenv('PREWARM_DECODE', 'False').lower() == 'true'
+WARM_START = os.getenv('WARM_START', 'True').lower() == 'true'
+
+class prewarmer:
+    def __init__(self,
+                 enabled: bool=PREWARM,
+                 assetOSList: List[AssetOS]=PREWARM_OS,
+                 prefixes: List[str]=PREWARM_PREFIXES,
+                 concurrency: int=PREWARM_CONCURRENCY,
+                 decode: bool=PREWARM_DECODE,
+                 warmStart: bool=WARM_START):
+        self.logger = Logger.getLogger('prewarmer')
+        self.enabled = enabled
+        self.assetOSList = assetOSList
+        self.prefixes = prefixes
+        self.concurrency = max(1, concurrency)
+        self.decode = decode
+        self.warmStart = warmStart
+        self.current: Optional[asyncio.Task] = None
+        self.warmTask: Optional[asyncio.Task] = None
+
+    async def versionChanged(self, version: int, oldVersion: Optional[int]):
+        # A newer version makes whatever is still being warmed pointless
+        if self.current is not None and not self.current.done():
+            self.logger.info('New assetVersion while prewarming, stopping the old run')
+            self.current.cancel()
+
+        self.current = asyncio.current_task()
+        for assetOS in self.assetOSList:
+            await self.prewarm(version, oldVersion, assetOS)
+
+    async def getPreviousVersion(self, version: int, oldVersion: Optional[int], assetOS: AssetOS) -> Optional[int]:
+        if oldVersion is not None:
+            return oldVersion
+
+        # Right after a restart there is no previous version in memory, the newest stored manifest is the next best thing
+        older = [stored for stored in await asyncio.to_thread(ManifestDecoder.getStoredVersions, assetOS) if stored < version]
+        return older[-1] if older else None
+
+    async def loadStoredManifests(self):
+        # Right after a restart the first requests are almost always for the newest manifest that was stored
+        for assetOS in AssetOS:
+            versions = await asyncio.to_thread(ManifestDecoder.getStoredVersions, assetOS)
+            if not versions:
+                continue
+            try:
+                await ManifestDecoder.getManifest(versions[-1], assetOS)
+                self.logger.info(f'Loaded stored manifest {versions[-1]} for {assetOS.name}')
+            except Exception as e:
+                self.logger.warning(f'Failed to load stored manifest {versions[-1]} for {assetOS.name}: {e}')
+
+    async def warm(self):
+        started = time.monotonic()
+        results = await asyncio.gather(self.loadStoredManifests(), DecodeEngine.warm(), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                self.logger.warning(f'Warm start failed: {result}')
+        self.logger.info(f'Warm start finished in {time.monotonic() - started:.1f}s')
+
+    def start(self):
+        # In the background, requests are served while the manifests load and the decode workers start
+        if self.warmStart and self.warmTask is None:
+            self.warmTask = asyncio.create_task(self.warm())
+
+    async def stop(self):
+        if self.warmTask is not None:
+            self.warmTask.cancel()
+            await asyncio.gather(self.warmTask, return_exceptions=True)
+            self.warmTask = None
+
+    def getChangedAssets(self, newManifest: ManifestDecoder.ParsedManifest, oldManifest: ManifestDecoder.ParsedManifest) -> List[str]:
+        names: List[str] = []
+        for prefix in self.prefixes or [None]:
+            # Bundles with the same size and crc are already on disk from the old version
+            names += ManifestDiff.compareManifest(newManifest.getRecords(prefix), oldManifest.getRecords(prefix), DiffVersion.ALL, skipUnchanged=True)
+
+        return names
+
+    async def prewarm(self, version: int, oldVersion: Optional[int], assetOS: AssetOS):
+        previousVersion = await self.getPreviousVersion(version, oldVersion, assetOS)
+        newManifest = await ManifestDecoder.getManifest(version, assetOS)
+        if previousVersion is None:
+            self.logger.info(f'Loaded manifest {version} for {assetOS.name}, there is no older manifest to diff against')
+            return
+
+        oldManifest = await ManifestDecoder.getManifest(previousVersion, assetOS)
+        names = self.getChangedAssets(newManifest, oldManifest)
+        self.logger.info(f'Prewarming {len(names)} bundles ({newManifest.getDownloadSize(names)} bytes) for {assetOS.name} {previousVersion} -> {version}')
+
+        started = time.monotonic()
+        # A fixed number of workers take names off the same iterator, so a big patch never has a task per bundle
+        queue = iter(names)
+
+        async def worker() -> int:
+            failed = 0
+            for name in queue:
+                try:
+                    await self.warmAsset(name, version, assetOS, newManifest.byName[name])
+                except Exception:
+                    failed += 1
+            return failed
+
+        failed = sum(await asyncio.gather(*[worker() for _ in range(min(self.concurrency, len(names)))]))
+        self.logger.info(f'Prewarmed {len(names) - failed}/{len(names)} bundles for {assetOS.name} in {time.monotonic() - started:.1f}s')
+
+    async def warmAsset(self, name: str, version: int, assetOS: AssetOS, record: Dict[str, Any]):
+        bundleVersion = getBundleVersion(record)
+        bundlePath = getBundlePath(name, bundleVersion, assetOS)
+        try:
+            if not await BundleCache.exists(bundlePath):
+                await RequestManager.getSaveAsset(name + getAssetExtension(name), version, bundlePath, assetOS, record['crc'], record['size'], Priority.PREWARM)
+            BundleCache.touch(bundlePath)
+            if self.decode:
+                await Texture2DDecoder.decodeManyImages(bundlePath, name, bundleVersion, assetOS)
+        except Exception as e:
+            self.logger.warning(f'Failed to prewarm {name}: {e}')
+            raise e
+
+Prewarmer = prewarmer()
\ No newline at end of file
@@ -1,28 +1,106 @@
 from fastapi import HTTPException
 from helpers import Logger
 from helpers.FileLock import GlobalFileLock as FileLock
-from helpers.TypeHelpers import AssetOS
-from typing import Union, Dict, List
+from helpers.BundleCache import BundleCache
+from helpers.SingleFlight import single_flight
+from helpers.DownloadScheduler import download_scheduler, download_ticket
+from helpers.Metrics import Metrics, SIZE_BUCKETS
+from helpers.TypeHelpers import AssetOS, Priority
+from typing import Union, Dict, List, Tuple, Optional, Callable, Awaitable, TypeVar
 import time
 import aiofiles
+import asyncio
+import importlib.util
 import hashlib
+import random
 import httpx
 import hmac
 import json
-import time
+import uuid
+import zlib
 import os
 
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_SIZE', str(256 * 1024)))
+VERIFY_CRC = os.getenv('VERIFY_CRC', 'False').lower() == 'true'
+CACHE_BUST = os.getenv('CACHE_BUST', 'False').lower() == 'true'
+CDN_URL = os.getenv('CDN_URL', 'https://eaassets-a.akamaihd.net/assetssw.capitalgames.com/PROD').rstrip('/')
+HTTP2 = os.getenv('HTTP2', 'False').lower() == 'true'
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', '100'))
+HTTP_MAX_KEEPALIVE = int(os.getenv('HTTP_MAX_KEEPALIVE', '20'))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', '30'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '10'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '30'))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', '3'))
+HTTP_RETRY_BACKOFF = float(os.getenv('HTTP_RETRY_BACKOFF', '0.5'))
+# Bundles get HTTP_READ_TIMEOUT plus however long they take at this speed to download in full
+HTTP_MIN_SPEED_KB = int(os.getenv('HTTP_MIN_SPEED_KB', '256'))
+
+T = TypeVar('T')
+
+downloadSeconds = Metrics.histogram('assetapi_download_seconds', 'Time taken to download a file from the CDN, retries included', labels=['priority'])
+downloadBytes = Metrics.histogram('assetapi_download_bytes', 'Size of files downloaded from the CDN', SIZE_BUCKETS, ['priority'])
+downloads = Metrics.counter('assetapi_downloads_total', 'CDN downloads by result', ['priority', 'result'])
+comlinkSeconds = Metrics.histogram('assetapi_comlink_seconds', 'Time taken to get the assetVersion from comlink')
+
+class ServerError(Exception):
+    def __init__(self, statusCode: int, content: bytes):
+        super().__init__(f'Server returned {statusCode}')
+        self.statusCode = statusCode
+        self.content = content
+
+def removePart(tempPath: str):
+    try:
+        os.remove(tempPath)
+    except FileNotFoundError:
+        pass
+
 class request_manager:
     def __init__(self):
         self.logger = Logger.getLogger("requestManager")
-        self.httpClient = httpx.AsyncClient()
+        self.httpClient = self.createClient()
+        self.downloads = single_flight(lambda key: self.tickets.pop(key, None))
+        self.tickets: Dict[Tuple[int, AssetOS, str], download_ticket] = {}
+        self.scheduler = download_scheduler()
 
-    async def getAsset(self, 
-                       asset: str, 
-                       version: int, 
-                       assetOS: AssetOS=AssetOS.WINDOWS, 
-                       response_type: str="content"
-                       ) -> Union[bytes, str, Dict, List, None]:
+    def createClient(self) -> httpx.AsyncClient:
+        http2 = HTTP2
+        if http2 and importlib.util.find_spec('h2') is None:
+            self.logger.warning('HTTP2 is enabled but the h2 package is not installed, falling back to HTTP/1.1')
+            http2 = False
+
+        return httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        )
+
+    def getTimeout(self, size: Optional[int]) -> Optional[float]:
+        if size is None or HTTP_MIN_SPEED_KB <= 0:
+            return None
+
+        return HTTP_READ_TIMEOUT + size / (HTTP_MIN_SPEED_KB * 1024)
+
+    async def withRetries(self, asset: str, attempt: Callable[[], Awaitable[T]]) -> T:
+        # Connection problems and 5xx from the CDN are usually gone a moment later, anything else fails straight away
+        tries = 0
+        while True:
+            try:
+                return await attempt()
+            except (httpx.TransportError, ServerError) as e:
+                if tries >= HTTP_RETRIES:
+                    raise e
+                delay = random.uniform(0, HTTP_RETRY_BACKOFF * 2 ** tries)
+                tries += 1
+                self.logger.warning(f'Retrying {asset} in {delay:.2f}s ({tries}/{HTTP_RETRIES}): {type(e).__name__} {e}')
+                await asyncio.sleep(delay)
+
+    def getAssetUrl(self, 
+                    asset: str, 
+                    version: int, 
+                    assetOS: AssetOS=AssetOS.WINDOWS
+                    ) -> str:
         match assetOS:
             case 0:
                 assetOSPath = "/Windows/ETC/"
@@ -33,11 +111,38 @@ class request_manager:
             case _:
                 assetOSPath = "/Windows/ETC/"
 
-        url = "https://eaassets-a.akamaihd.net/assetssw.capitalgames.com/PROD/{}{}{}?callingService=assetapi&cacheBust={}".format(version, assetOSPath, asset, str(time.time() * 1000))
+        url = "{}/{}{}{}?callingService=assetapi".format(CDN_URL, version, assetOSPath, asset)
+        # A fresh cacheBust on every request means Akamai can never answer from its edge cache
+        if CACHE_BUST:
+            url += "&cacheBust={}".format(str(time.time() * 1000))
+
+        return url
+
+    async def getAsset(self, 
+                       asset: str, 
+                       version: int, 
+                       assetOS: AssetOS=AssetOS.WINDOWS, 
+                       response_type: str="content", 
+                       priority: Priority=Priority.INTERACTIVE
+                       ) -> Union[bytes, str, Dict, List, None]:
+        url = self.getAssetUrl(asset, version, assetOS)
+        ticket = self.scheduler.createTicket(priority)
 
+        async def attempt() -> httpx.Response:
+            async with self.scheduler.slot(ticket):
+                response = await self.httpClient.get(url)
+                await self.scheduler.consume(ticket, len(response.content))
+            if response.status_code >= 500:
+                raise ServerError(response.status_code, response.content)
+            return response
+
+        started = time.perf_counter()
+        succeeded = False
         try:
-            response = await self.httpClient.get(url)
+            response = await self.withRetries(asset, attempt)
             if response.status_code == 200:
+                self.recordDownload(ticket, started, len(response.content))
+                succeeded = True
                 match response_type:
                     case "text":
                         return response.text
@@ -50,6 +155,9 @@ class request_manager:
                 self.logger.warning(f'Returned status code was "{response.status_code}" expected "200" message is "{response.content}"')
                 raise HTTPException(status_code=500, detail=f"Failed to get {asset} from EA server")
             
+        except ServerError as e:
+            self.logger.warning(f'Returned status code was "{e.statusCode}" expected "200" message is "{e.content}"')
+            raise HTTPException(status_code=500, detail=f"Failed to get {asset} from EA server")
         except httpx.ConnectError as e:
             self.logger.warning(f'Failed to download {asset}(ConnectionError): {e}')
             raise HTTPException(status_code=500, detail=f"Failed to get {asset} from EA server")
@@ -59,22 +167,109 @@ class request_manager:
         except httpx.RequestError as e:
             self.logger.warning(f'Failed to download {asset}(RequestException): {e}')
             raise HTTPException(status_code=500, detail=f"Failed to get {asset} from EA server")
+        finally:
+            if not succeeded:
+                downloads.inc(ticket.priority.name.lower(), 'error')
+
+    def recordDownload(self, ticket: download_ticket, started: float, size: int):
+        priority = ticket.priority.name.lower()
+        downloadSeconds.observe(time.perf_counter() - started, priority)
+        downloadBytes.observe(size, priority)
+        downloads.inc(priority, 'ok')
         
     async def getSaveAsset(self, 
                            asset: str, 
                            version: int, 
                            filepath: str, 
-                           assetOS: AssetOS=AssetOS.WINDOWS):
-        assetData = await self.getAsset(asset, version, assetOS, response_type="content")
+                           assetOS: AssetOS=AssetOS.WINDOWS, 
+                           crc: Optional[int]=None, 
+                           size: Optional[int]=None, 
+                           priority: Priority=Priority.INTERACTIVE):
+        key = (version, assetOS, asset)
+        ticket = self.tickets.get(key)
+        if ticket is None:
+            ticket = self.scheduler.createTicket(priority)
+            self.tickets[key] = ticket
+        else:
+            self.logger.debug(f'Joining in flight download of {asset}')
+            # An interactive request shouldn't wait behind prewarm traffic just because prewarming asked first
+            ticket.raisePriority(priority)
 
-        if not isinstance(assetData, (bytes, bytearray)):
-            self.logger.warning(f"Asset data for {asset} is not bytes or str, got {type(assetData)}")
-            raise TypeError(f"Asset data for {asset} is not bytes or str, got {type(assetData)}")
-        
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        async with FileLock.claimFile(os.path.abspath(filepath)):
-            async with aiofiles.open(filepath, 'wb') as file:
-                await file.write(assetData)
+        await self.downloads.run(key, lambda: self.downloadAsset(asset, version, filepath, assetOS, crc, size, ticket))
+
+    async def streamToFile(self, asset: str, url: str, tempPath: str, timeout: Optional[float], ticket: download_ticket) -> Tuple[int, int]:
+        checksum = 0
+        size = 0
+        # The deadline starts once the scheduler lets the download go, time spent queued doesn't count
+        async with self.scheduler.slot(ticket), asyncio.timeout(timeout):
+            async with self.httpClient.stream('GET', url) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    if response.status_code >= 500:
+                        raise ServerError(response.status_code, response.content)
+                    self.logger.warning(f'Returned status code was "{response.status_code}" expected "200" message is "{response.content}"')
+                    raise HTTPException(status_code=500, detail=f"Failed to get {asset} from EA server")
+
+                # Opened for every attempt, so a retry starts from an empty file
+                async with aiofiles.open(tempPath, 'wb') as file:
+                    async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                        checksum = zlib.crc32(chunk, checksum)
+                        size += len(chunk)
+                        await file.write(chunk)
+                        await self.scheduler.consume(ticket, len(chunk))
+
+        return checksum, size
+
+    async def downloadAsset(self, 
+                            asset: str, 
+                            version: int, 
+                            filepath: str, 
+                            assetOS: AssetOS=AssetOS.WINDOWS, 
+                            crc: Optional[int]=None, 
+                            size: Optional[int]=None, 
+                            ticket: Optional[download_ticket]=None):
+        url = self.getAssetUrl(asset, version, assetOS)
+        ticket = ticket or self.scheduler.createTicket(Priority.INTERACTIVE)
+        timeout = self.getTimeout(size)
+
+        await asyncio.to_thread(os.makedirs, os.path.dirname(filepath), exist_ok=True)
+        # Stream into a file next to the real one and rename it into place, so only one chunk is ever held
+        # in memory and nobody sees a half written bundle
+        tempPath = f'{filepath}.{uuid.uuid4().hex}.part'
+        started = time.perf_counter()
+        succeeded = False
+        try:
+            checksum, downloaded = await self.withRetries(asset, lambda: self.streamToFile(asset, url, tempPath, timeout, ticket))
+
+            if VERIFY_CRC and crc is not None and checksum != crc:
+                self.logger.warning(f'CRC mismatch for {asset}, expected {crc} got {checksum}')
+                raise HTTPException(status_code=500, detail=f"Downloaded {asset} does not match the manifest crc")
+
+            async with FileLock.claimFile(os.path.abspath(filepath)):
+                await asyncio.to_thread(os.replace, tempPath, filepath)
+            BundleCache.touch(filepath, downloaded)
+            self.recordDownload(ticket, started, downloaded)
+            succeeded = True
+        except ServerError as e:
+            self.logger.warning(f'Returned status code was "{e.statusCode}" expected "200" message is "{e.content}"')
+            raise HTTPException(status_code=500, detail=f"Failed to get {asset} from EA server")
+        except TimeoutError:
+            limit = f'{timeout:.0f}s' if timeout is not None else 'the read timeout'
+            self.logger.warning(f'Failed to download {asset}(Timeout): took longer than {limit}')
+            raise HTTPException(status_code=500, detail=f"Failed to get {asset} from EA server")
+        except httpx.ConnectError as e:
+            self.logger.warning(f'Failed to download {asset}(ConnectionError): {e}')
+            raise HTTPException(status_code=500, detail=f"Failed to get {asset} from EA server")
+        except httpx.ReadTimeout as e:
+            self.logger.warning(f'Failed to download {asset}(Timeout): {e}')
+            raise HTTPException(status_code=500, detail=f"Failed to get {asset} from EA server")
+        except httpx.RequestError as e:
+            self.logger.warning(f'Failed to download {asset}(RequestException): {e}')
+            raise HTTPException(status_code=500, detail=f"Failed to get {asset} from EA server")
+        finally:
+            if not succeeded:
+                downloads.inc(ticket.priority.name.lower(), 'error')
+                await asyncio.to_thread(removePart, tempPath)
         
     async def getAssetVersion(self, 
                               url_base: str, 
@@ -105,8 +300,10 @@ class request_manager:
                 hmac_digest = hmac_obj.hexdigest()
                 
                 req_headers['Authorization'] = f'HMAC-SHA256 Credential={access_key},Signature={hmac_digest}'
+            started = time.perf_counter()
             try:
                 response = await self.httpClient.post(post_url, json=payload, headers=req_headers)
+                comlinkSeconds.observe(time.perf_counter() - started)
 
                 return json.loads(response.content.decode('utf-8'))['assetVersion']
             except httpx.ConnectError as e:
@@ -119,4 +316,8 @@ class request_manager:
                 self.logger.warning(f'Failed to download version from comlink (RequestException): {e}')
                 raise HTTPException(status_code=500, detail=f"Failed to get version from comlink")
 
-RequestManager = request_manager()
\ No newline at end of file
+RequestManager = request_manager()
+Metrics.gauge('assetapi_downloads_in_flight', 'Bundle downloads that are queued or running', lambda: len(RequestManager.downloads))
+Metrics.gauge('assetapi_cdn_requests', 'CDN requests in the scheduler by state and priority',
+              lambda: RequestManager.scheduler.getCounts(), ['state', 'priority'])
+Metrics.gauge('assetapi_cdn_bytes_per_second', 'CDN download speed averaged over the last 10 seconds', lambda: RequestManager.scheduler.getThroughput())
\ No newline at end of file
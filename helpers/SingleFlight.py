@@ -0,0 +1,31 @@
+from typing import Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+import asyncio
+
+T = TypeVar('T')
+
+class single_flight:
+    def __init__(self, onFinished: Optional[Callable[[Hashable], None]]=None):
+        self.tasks: Dict[Hashable, asyncio.Task] = {}
+        self.onFinished = onFinished
+
+    def __len__(self) -> int:
+        return len(self.tasks)
+
+    async def run(self, key: Hashable, load: Callable[[], Awaitable[T]]) -> T:
+        # Callers asking for a key that is already being loaded wait on that load instead of starting another
+        task = self.tasks.get(key)
+        if task is None:
+            task = asyncio.create_task(load())
+            self.tasks[key] = task
+            task.add_done_callback(lambda finished: self.finished(key, finished))
+
+        # Shielded so one caller going away doesn't cancel the load for everyone else waiting on it
+        return await asyncio.shield(task)
+
+    def finished(self, key: Hashable, task: asyncio.Task):
+        self.tasks.pop(key, None)
+        if self.onFinished is not None:
+            self.onFinished(key)
+        if not task.cancelled():
+            # Marks the exception as retrieved in case every waiter went away
+            task.exception()
\ No newline at end of file
@@ -1,67 +1,218 @@
 from helpers.Logger import getLogger
 from helpers.FileLock import GlobalFileLock as FileLock
-from PIL import Image
-from typing import Tuple, Dict, List, Union
-from io import BytesIO
-import UnityPy
+from helpers.DecodeEngine import DecodeEngine
+from helpers.ImageCache import ImageCache
+from helpers.BundleCache import BundleCache
+from helpers.TypeHelpers import AssetOS, ImageFormat, ObjectType
+from helpers import DecodeWorker
+from helpers.DecodeWorker import NoAssetFoundError
+from helpers.Metrics import Metrics
+from typing import Tuple, Dict, List, Optional, Union, Any
 import base64
+import json
 import os
 
 logger = getLogger('texture2DDecoder')
 
-class NoAssetFoundError(Exception):
-    pass
+loadSeconds = Metrics.histogram('assetapi_unitypy_load_seconds', 'Time UnityPy takes to load a bundle')
+imageDecodeSeconds = Metrics.histogram('assetapi_image_decode_seconds', 'Time taken to decode one texture into an image')
+pngEncodeSeconds = Metrics.histogram('assetapi_png_encode_seconds', 'Time taken to encode one image', labels=['format'])
 
-async def decodeAsset(filepath: str) -> Tuple[Image.Image, str]:
-    async with FileLock.claimFile(os.path.abspath(filepath)):
-        env = UnityPy.load(filepath)
+# (media type, file extension, default quality, highest quality) per format
+IMAGE_TYPES = {
+    ImageFormat.PNG: ('image/png', '.png', 6, 9),
+    ImageFormat.WEBP_LOSSLESS: ('image/webp', '.webp', 80, 100),
+    ImageFormat.WEBP: ('image/webp', '.webp', 80, 100),
+    ImageFormat.RGBA: ('application/octet-stream', '.rgba', 0, 0)
+}
+
+# The format and the quality it was encoded with, both are part of the cache key
+Encoding = Tuple[ImageFormat, int]
+DEFAULT_ENCODING: Encoding = (ImageFormat.PNG, 6)
+
+def getEncoding(imageFormat: ImageFormat, quality: Optional[int]=None) -> Encoding:
+    _, _, defaultQuality, highest = IMAGE_TYPES[imageFormat]
+    if imageFormat == ImageFormat.RGBA or quality is None:
+        return imageFormat, defaultQuality
+    if not 0 <= quality <= highest:
+        raise ValueError(f'quality for {imageFormat.name} has to be between 0 and {highest}')
+
+    return imageFormat, quality
+
+def recordTimings(timings: DecodeWorker.Timings, encoding: Encoding):
+    for seconds in timings["load"]:
+        loadSeconds.observe(seconds)
+    for seconds in timings["decode"]:
+        imageDecodeSeconds.observe(seconds)
+    for seconds in timings["encode"]:
+        pngEncodeSeconds.observe(seconds, encoding[0].name.lower())
+
+# Decoded images are cached per object and encoding, the bundle level entries only list which objects a bundle holds.
+# Keys use the bundle version from the manifest, so images of unchanged bundles carry over to new assetVersions
+def getObjectKey(assetName: str, bundleVersion: str, assetOS: AssetOS, objectName: str, pathId: int, encoding: Encoding) -> Tuple[Any, ...]:
+    return (assetName, bundleVersion, int(assetOS), objectName, pathId, int(encoding[0]), encoding[1])
+
+def getBundleKey(assetName: str, bundleVersion: str, assetOS: AssetOS, kind: str) -> Tuple[Any, ...]:
+    return (assetName, bundleVersion, int(assetOS), kind)
+
+# Object names and UnityPy type names to decode, None for either means no filter
+Selection = Tuple[Optional[List[str]], Optional[List[str]]]
+NO_SELECTION: Selection = (None, None)
 
-    for obj in env.objects:
-        if obj.type.name in ["Texture2D", "Sprite"]:
-                data = obj.read()
-                img_name = data.m_Name
-                img = data.image
+OBJECT_TYPES = {
+    ObjectType.ALL: None,
+    ObjectType.TEXTURE2D: ["Texture2D"],
+    ObjectType.SPRITE: ["Sprite"]
+}
 
-                return img, img_name
-        
-    raise NoAssetFoundError(f'No supported assets found in {filepath}')
+def getSelection(objectNames: Optional[List[str]]=None, objectType: ObjectType=ObjectType.ALL) -> Selection:
+    return (sorted(set(objectNames)) if objectNames else None), OBJECT_TYPES[objectType]
 
-def imgToB64(image: Image.Image, format: str='PNG') -> str:
-    buffered = BytesIO()
-    image.save(buffered, format=format)
-    img_bytes = buffered.getvalue()
-    base64_img = base64.b64encode(img_bytes).decode('utf-8')
+def getSelectionKind(kind: str, selection: Selection) -> str:
+    # A selection is cached under its own listing, next to the listing of the whole bundle
+    return kind if selection == NO_SELECTION else f'{kind}:{json.dumps(selection)}'
 
-    return f"data:image/png;base64,{base64_img}"
+def selectEntries(entries: List[Dict[str, Any]], selection: Selection) -> Optional[List[Dict[str, Any]]]:
+    names, types = selection
+    # Listings cached before the type was stored can't answer a type filter
+    if types is not None and any("type" not in entry for entry in entries):
+        return None
 
-async def decodeManyAssets(filepath: str) -> List[Dict[str, Union[str, bool]]]:
+    return [entry for entry in entries if (names is None or entry["name"] in names) and (types is None or entry["type"] in types)]
+
+# Images are kept as raw bytes until the response is built, so streamed responses never hold base64 copies
+Image = Dict[str, Union[str, bytes, bool, int]]
+
+def toListing(image: Image) -> Dict[str, Union[str, bool, int]]:
+    return {key: value for key, value in image.items() if key != "img"}
+
+def fromListing(entry: Dict[str, Any], data: bytes) -> Image:
+    # Listings cached before width and height were stored don't have them
+    return {**entry, "img": data, "width": entry.get("width", 0), "height": entry.get("height", 0)}
+
+async def submitDecode(task: Any, filepath: str, encoding: Encoding, selection: Selection) -> Any:
     async with FileLock.claimFile(os.path.abspath(filepath)):
-        env = UnityPy.load(filepath)
-
-    response: List[Dict[str, Union[str, bool]]] = []
-    for obj in env.objects:
-        if obj.type.name in ["Texture2D", "Sprite"]:
-                data = obj.read()
-                img_name = data.m_Name
-                # This if statment is to catch empty images such as in shared_resourcecontainer.bundle "Font Texture"
-                # Not catching these causes a PermissionError when running data.image
-                # The error stems from not having m_StreamData.path or another format that may be used
-                # To ensure that an asset exists please check "pass"
-                if obj.type.name == "Texture2D":
-                     if data.m_StreamData.path == "" and data.m_ImageCount == 0 and data.m_Width == 0:
-                          response.append({
-                                "name": img_name,
-                                "img": "",
-                                "valid": False
-                            })
-                          continue
-                     
-                img = data.image
-
-                response.append({
-                     "name": img_name,
-                     "img": imgToB64(img),
-                     "valid": True
-                })
-
-    return response
\ No newline at end of file
+        try:
+            return await DecodeEngine.submit(task, os.path.abspath(filepath), *encoding, *selection)
+        except FileNotFoundError:
+            # Another worker or /cleanup removed a bundle that was still indexed, the next request downloads it again
+            BundleCache.forget(filepath)
+            raise
+
+async def decodeAsset(filepath: str,
+                      assetName: str,
+                      bundleVersion: str,
+                      assetOS: AssetOS=AssetOS.WINDOWS,
+                      refresh: bool=False,
+                      encoding: Encoding=DEFAULT_ENCODING,
+                      selection: Selection=NO_SELECTION
+                      ) -> Image:
+    firstKey = getBundleKey(assetName, bundleVersion, assetOS, getSelectionKind('first', selection))
+
+    if not refresh:
+        first = await ImageCache.get(firstKey)
+        if first is not None:
+            entry = json.loads(first)
+        else:
+            # The first object of a bundle /Asset/many already decoded is good enough
+            listing = await ImageCache.get(getBundleKey(assetName, bundleVersion, assetOS, 'all'))
+            entries = selectEntries(json.loads(listing), selection) if listing is not None else None
+            entry = entries[0] if entries and entries[0]["valid"] else None
+
+        if entry is not None:
+            image = await ImageCache.get(getObjectKey(assetName, bundleVersion, assetOS, entry["name"], entry["pathId"], encoding))
+            if image is not None:
+                return fromListing(entry, image)
+
+    decoded, timings = await submitDecode(DecodeWorker.decodeFirst, filepath, encoding, selection)
+    recordTimings(timings, encoding)
+
+    await ImageCache.put(getObjectKey(assetName, bundleVersion, assetOS, decoded["name"], decoded["pathId"], encoding), decoded["img"])
+    await ImageCache.put(firstKey, json.dumps(toListing(decoded)).encode())
+
+    return decoded
+
+def imgToB64(image: bytes, mediaType: str='image/png') -> str:
+    base64_img = base64.b64encode(image).decode('utf-8')
+
+    return f"data:{mediaType};base64,{base64_img}"
+
+async def getCachedManyImages(assetName: str,
+                              bundleVersion: str,
+                              assetOS: AssetOS,
+                              encoding: Encoding=DEFAULT_ENCODING,
+                              selection: Selection=NO_SELECTION
+                              ) -> Union[List[Image], None]:
+    # The listing of the whole bundle can answer any selection, the selection's own listing only itself
+    for kind in dict.fromkeys(['all', getSelectionKind('all', selection)]):
+        listing = await ImageCache.get(getBundleKey(assetName, bundleVersion, assetOS, kind))
+        entries = selectEntries(json.loads(listing), selection) if listing is not None else None
+        if entries is not None:
+            images = await getCachedImages(assetName, bundleVersion, assetOS, encoding, entries)
+            if images is not None:
+                return images
+
+    return None
+
+async def getCachedImages(assetName: str,
+                          bundleVersion: str,
+                          assetOS: AssetOS,
+                          encoding: Encoding,
+                          entries: List[Dict[str, Any]]
+                          ) -> Union[List[Image], None]:
+    response: List[Image] = []
+    for entry in entries:
+        if not entry["valid"]:
+            response.append(fromListing(entry, b""))
+            continue
+
+        image = await ImageCache.get(getObjectKey(assetName, bundleVersion, assetOS, entry["name"], entry["pathId"], encoding))
+        if image is None:
+            # One of the images was evicted or was never encoded like this, decode the bundle again
+            return None
+        response.append(fromListing(entry, image))
+
+    return response
+
+async def decodeManyImages(filepath: str,
+                           assetName: str,
+                           bundleVersion: str,
+                           assetOS: AssetOS=AssetOS.WINDOWS,
+                           refresh: bool=False,
+                           encoding: Encoding=DEFAULT_ENCODING,
+                           selection: Selection=NO_SELECTION
+                           ) -> List[Image]:
+    if not refresh:
+        cached = await getCachedManyImages(assetName, bundleVersion, assetOS, encoding, selection)
+        if cached is not None:
+            return cached
+
+    decoded, timings = await submitDecode(DecodeWorker.decodeAll, filepath, encoding, selection)
+    recordTimings(timings, encoding)
+
+    for entry in decoded:
+        if entry["valid"]:
+            await ImageCache.put(getObjectKey(assetName, bundleVersion, assetOS, entry["name"], entry["pathId"], encoding), entry["img"])
+    await ImageCache.put(getBundleKey(assetName, bundleVersion, assetOS, getSelectionKind('all', selection)), json.dumps([toListing(entry) for entry in decoded]).encode())
+
+    return decoded
+
+def toDataUris(images: List[Image], imageFormat: ImageFormat=ImageFormat.PNG) -> List[Dict[str, Union[str, bool, int]]]:
+    mediaType = IMAGE_TYPES[imageFormat][0]
+    return [{
+        "name": image["name"],
+        "img": imgToB64(image["img"], mediaType) if image["valid"] else "",
+        "valid": image["valid"],
+        "width": image["width"],
+        "height": image["height"]
+    } for image in images]
+
+async def decodeManyAssets(filepath: str,
+                           assetName: str,
+                           bundleVersion: str,
+                           assetOS: AssetOS=AssetOS.WINDOWS,
+                           refresh: bool=False,
+                           encoding: Encoding=DEFAULT_ENCODING,
+                           selection: Selection=NO_SELECTION
+                           ) -> List[Dict[str, Union[str, bool, int]]]:
+    return toDataUris(await decodeManyImages(filepath, assetName, bundleVersion, assetOS, refresh, encoding, selection), encoding[0])
\ No newline at end of file
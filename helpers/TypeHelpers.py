@@ -10,6 +10,34 @@ class DiffVersion(int, Enum):
     NEW = 1
     CHANGED = 2
 
+class Priority(int, Enum):
+    INTERACTIVE = 0
+    BULK = 1
+    PREWARM = 2
+
+class DependencyMode(int, Enum):
+    NONE = 0
+    DEPENDENCIES = 1
+    DEPENDENTS = 2
+
+class BatchFormat(int, Enum):
+    JSON = 0
+    ZIP = 1
+    TAR = 2
+    NDJSON = 3
+    SSE = 4
+
+class ImageFormat(int, Enum):
+    PNG = 0
+    WEBP_LOSSLESS = 1
+    WEBP = 2
+    RGBA = 3
+
+class ObjectType(int, Enum):
+    ALL = 0
+    TEXTURE2D = 1
+    SPRITE = 2
+
 class Swagger:
     versionDesc = 'Asset version to download from. You can get this from Comlink /metadata or set this to 0 to pull from Comlink if you have that configured.'
     assetNameDesc = 'The name of the asset you want. Get it from /Asset/list.'
@@ -18,4 +46,12 @@ class Swagger:
     assetNamesDesc = 'The names of all the assets you wanted seperated by a comma. Get asset names from /Asset/list'
     diffVersionDesc = 'The version you want to compare to. Usually this should be older.'
     diffTypeDesc = 'Limit how assets are decided as different. New assets = 1, changed = 2, both = 0.'
-    prefixDesc = 'Limit to specific prefixes such as charui'
\ No newline at end of file
+    prefixDesc = 'Limit to specific prefixes such as charui'
+    dependencyModeDesc = 'Also return bundles linked to the diff through the manifest. 1 adds everything the changed bundles depend on, 2 adds everything that depends on them, 0 adds nothing.'
+    skipUnchangedDesc = 'If true, assets with a new version but the same size and crc are not counted as changed.'
+    batchFormatDesc = 'How the images are returned. 0 is a JSON list with base64 images, 1 streams a ZIP archive of PNGs, 2 streams a tar archive of PNGs, 3 streams newline delimited JSON and 4 streams Server-Sent Events. Archives also hold a metadata.json per asset.'
+    imageFormatDesc = 'The format images are encoded in. 0 is PNG, 1 is lossless WebP, 2 is lossy WebP, 3 is raw RGBA pixels with the size in the width and height fields.'
+    qualityDesc = 'Encoder setting for the imageFormat. For PNG it is the compress level from 0 to 9 (default 6, lower is faster and bigger). For WebP it is 0 to 100 (default 80), the quality for lossy and the effort for lossless. Ignored for RGBA.'
+    objectNameDesc = 'Only decode the Texture2D or Sprite with this name, for example one sprite out of an atlas bundle.'
+    objectNamesDesc = 'Only decode the Texture2D and Sprite objects with these names, seperated by a comma.'
+    objectTypeDesc = 'Only decode objects of this type. 1 is Texture2D, 2 is Sprite, 0 is both.'
\ No newline at end of file
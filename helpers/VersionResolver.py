@@ -0,0 +1,108 @@
+from helpers import Logger
+from helpers.RequestManager import RequestManager
+from helpers.SingleFlight import single_flight
+from typing import Awaitable, Callable, List, Optional, Set
+import asyncio
+import time
+import os
+
+VERSION_TTL = float(os.getenv('VERSION_TTL', '60'))
+VERSION_POLL_INTERVAL = float(os.getenv('VERSION_POLL_INTERVAL', '30'))
+
+# Called with (newVersion, oldVersion). oldVersion is None the first time a version is resolved
+VersionListener = Callable[[int, Optional[int]], Awaitable[None]]
+
+class version_resolver:
+    def __init__(self, ttl: float=VERSION_TTL, pollInterval: float=VERSION_POLL_INTERVAL):
+        self.logger = Logger.getLogger('versionResolver')
+        self.ttl = ttl
+        self.pollInterval = pollInterval
+        self.url = 'False'
+        self.secretKey = 'False'
+        self.accessKey = 'False'
+        self.version: Optional[int] = None
+        self.fetchedAt = 0.0
+        self.fetches = single_flight()
+        self.poller: Optional[asyncio.Task] = None
+        self.listeners: List[VersionListener] = []
+        self.listenerTasks: Set[asyncio.Task] = set()
+
+    def configure(self, url: str, secretKey: str='False', accessKey: str='False'):
+        self.url = url
+        self.secretKey = secretKey
+        self.accessKey = accessKey
+
+    def isConfigured(self) -> bool:
+        return self.url != 'False'
+
+    def onVersionChange(self, listener: VersionListener) -> VersionListener:
+        self.listeners.append(listener)
+        return listener
+
+    async def resolve(self, version: int) -> int:
+        if version != 0 or not self.isConfigured():
+            return version
+
+        return await self.getVersion()
+
+    async def getVersion(self, refresh: bool=False) -> int:
+        if not refresh and self.version is not None and time.monotonic() - self.fetchedAt < self.ttl:
+            return self.version
+
+        # Every request that misses at the same time waits on the same call to comlink
+        try:
+            return await self.fetches.run('assetVersion', self.fetchVersion)
+        except Exception as e:
+            if self.version is None:
+                raise e
+            # Comlink being down shouldn't take the API with it, the last version is still good enough
+            self.logger.warning(f'Failed to refresh assetVersion, using {self.version}: {e}')
+            return self.version
+
+    async def fetchVersion(self) -> int:
+        version = await RequestManager.getAssetVersion(self.url, secret_key=self.secretKey, access_key=self.accessKey)
+        self.setVersion(version)
+
+        return version
+
+    def setVersion(self, version: int):
+        oldVersion = self.version
+        self.version = version
+        self.fetchedAt = time.monotonic()
+
+        if version != oldVersion:
+            self.logger.info(f'Got assetVersion of {version} from comlink')
+            for listener in self.listeners:
+                task = asyncio.create_task(self.runListener(listener, version, oldVersion))
+                self.listenerTasks.add(task)
+                task.add_done_callback(self.listenerTasks.discard)
+
+    async def runListener(self, listener: VersionListener, version: int, oldVersion: Optional[int]):
+        try:
+            await listener(version, oldVersion)
+        except Exception as e:
+            self.logger.exception(f'Version change listener {listener.__name__} failed: {e}')
+
+    async def poll(self):
+        while True:
+            try:
+                await self.getVersion(refresh=True)
+            except Exception as e:
+                self.logger.warning(f'Failed to poll comlink for the assetVersion: {e}')
+            await asyncio.sleep(self.pollInterval)
+
+    def start(self):
+        if self.isConfigured() and self.pollInterval > 0 and self.poller is None:
+            self.poller = asyncio.create_task(self.poll())
+
+    async def stop(self):
+        tasks = list(self.listenerTasks)
+        if self.poller is not None:
+            tasks.append(self.poller)
+            self.poller = None
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+VersionResolver = version_resolver()
\ No newline at end of file
@@ -0,0 +1,57 @@
+# Run from the repository root with: python -m unittest discover tests
+import multiprocessing
+import unittest
+import asyncio
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('LOG_FILE', 'False')
+
+from helpers.DecodeEngine import decode_engine, DecodeTimeoutError
+
+def isRunning(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+class DecodeEngineRestartTest(unittest.TestCase):
+    def test_no_child_outlives_restart(self):
+        async def run():
+            engine = decode_engine(workers=2, timeout=3)
+            try:
+                await engine.warm()
+                stuck = asyncio.ensure_future(engine.submit(time.sleep, 30))
+                while not engine.startedOn:
+                    await asyncio.sleep(0.05)
+                    engine.readStarted()
+                stuckPid = list(engine.startedOn.values())[0]
+
+                # Still running on the other worker when the stuck one is killed
+                engine.timeout = 60
+                other = asyncio.ensure_future(engine.submit(time.sleep, 5))
+                while len(engine.startedOn) < 2:
+                    await asyncio.sleep(0.05)
+                    engine.readStarted()
+
+                with self.assertRaises(DecodeTimeoutError):
+                    await stuck
+                self.assertFalse(isRunning(stuckPid))
+                self.assertLessEqual(len(multiprocessing.active_children()), engine.workers)
+
+                # The other task is resubmitted to the new pool instead of failing
+                self.assertIsNone(await other)
+                self.assertEqual(await engine.submit(abs, -1), 1)
+                self.assertLessEqual(len(multiprocessing.active_children()), engine.workers)
+            finally:
+                engine.shutdown()
+
+        started = time.perf_counter()
+        asyncio.run(run())
+        self.assertLess(time.perf_counter() - started, 25)
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file